@@ -0,0 +1,33 @@
+import json
+
+'''
+asgi_request(app, method, path, body=None, headers=None)
+    calls the ASGI 'app' in process like the test client of Flask, for
+    the tests and benchmarks of flaskr/asgi.py. Returns (status, headers,
+    decoded JSON body).
+'''
+
+
+async def asgi_request(app, method, path, body=None, headers=None):
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query.encode(),
+        'headers': [(name.lower().encode(), value.encode())
+                    for name, value in (headers or {}).items()]
+    }
+    request_body = json.dumps(body).encode() if body is not None else b''
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': request_body}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start, response = messages
+    return start['status'], dict(start['headers']), \
+        json.loads(response['body'])
@@ -0,0 +1,150 @@
+'''
+Benchmark of POST /quizzes on the Flask app, served by a pool of
+threads, against the ASGI app, served by coroutines on one event loop.
+
+    python benchmarks/bench_asgi.py [--latency 0.002] [--database URI]
+
+Both apps are called in process, without an HTTP server, on a SQLite
+database filled with --questions questions. --latency adds a wait to
+each query, like the round trip to a database on another host; this is
+where a thread per request runs out before a coroutine per request.
+Needs the packages of requirements-asgi.txt.
+'''
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+
+from asgi_client import asgi_request  # noqa: E402
+from flaskr import create_app  # noqa: E402
+from flaskr.asgi import create_asgi_app  # noqa: E402
+from models import db, Category, Question  # noqa: E402
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment',
+              'Sports']
+
+
+def quiz_body(index):
+    # every other player plays 'All', the others one category
+    category = index % (len(CATEGORIES) + 1)
+    return {
+        'previous_questions': [],
+        'quiz_category': {
+            'id': category,
+            'type': 'click' if not category else CATEGORIES[category - 1]
+        }
+    }
+
+
+def fill(app, count):
+    app.test_cli_runner().invoke(args=['db', 'upgrade'])
+    with app.app_context():
+        if Category.query.count():
+            return
+        db.session.execute(Category.__table__.insert(), [
+            {'type': category_type} for category_type in CATEGORIES])
+        db.session.execute(Question.__table__.insert(), [{
+            'question': 'What is question number {} about?'.format(i),
+            'answer': 'The answer to question {}'.format(i),
+            'category': i % len(CATEGORIES) + 1,
+            'difficulty': i % 5 + 1
+        } for i in range(count)])
+        db.session.commit()
+
+
+def summary(name, started, latencies):
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print('{:<6} {:>8.0f} req/s   p50 {:>7.1f} ms   p99 {:>7.1f} ms'.format(
+        name, len(latencies) / elapsed,
+        latencies[len(latencies) // 2] * 1e3,
+        latencies[int(len(latencies) * 0.99)] * 1e3))
+
+
+def bench_wsgi(app, requests, threads):
+    def play(index):
+        start = time.perf_counter()
+        response = app.test_client().post('/quizzes', json=quiz_body(index))
+        assert response.status_code == 200, response.data
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        # connections and caches are set up before timing
+        list(executor.map(play, range(threads)))
+        started = time.perf_counter()
+        latencies = list(executor.map(play, range(requests)))
+    summary('wsgi', started, latencies)
+
+
+async def bench_asgi(app, requests, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def play(index):
+        async with slots:
+            start = time.perf_counter()
+            status, _, body = await asgi_request(
+                app, 'POST', '/quizzes', quiz_body(index))
+            assert status == 200, body
+            return time.perf_counter() - start
+
+    await asyncio.gather(*[play(index) for index in range(concurrency)])
+    started = time.perf_counter()
+    latencies = await asyncio.gather(
+        *[play(index) for index in range(requests)])
+    summary('asgi', started, list(latencies))
+
+
+def add_latency(flask_app, asgi_app, latency):
+    # a wait before each query of both apps
+    with flask_app.app_context():
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *args: time.sleep(latency))
+
+    database = asgi_app.database
+    for name in ('execute', 'fetch_all', 'fetch_one', 'fetch_val'):
+        def delayed(*args, query=getattr(database, name), **kwargs):
+            async def wait_and_query():
+                await asyncio.sleep(latency)
+                return await query(*args, **kwargs)
+            return wait_and_query()
+        setattr(database, name, delayed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', help='URI of an existing database')
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16,
+                        help='threads serving the Flask app')
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help='requests in flight on the ASGI app')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to each query')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    uri = args.database or 'sqlite:///' + os.path.join(directory, 'bench.db')
+    flask_app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    fill(flask_app, args.questions)
+    asgi_app = create_asgi_app({'SQLALCHEMY_DATABASE_URI': uri})
+    if args.latency:
+        add_latency(flask_app, asgi_app, args.latency)
+
+    print(json.dumps({key: value for key, value in vars(args).items()
+                      if key != 'database'}))
+    bench_wsgi(flask_app, args.requests, args.threads)
+    asyncio.get_event_loop().run_until_complete(
+        bench_asgi(asgi_app, args.requests, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
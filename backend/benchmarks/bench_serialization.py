@@ -0,0 +1,78 @@
+'''
+Microbenchmark of the list endpoint serialization: format() + jsonify
+against joining the cached JSON fragments of the questions.
+
+    python benchmarks/bench_serialization.py [questions per page]
+
+Runs without a database, the questions are built in memory.
+'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, jsonify  # noqa: E402
+
+from models import Question  # noqa: E402
+from flaskr.serialization import (  # noqa: E402
+    FragmentCache, json_response, orjson)
+
+REPEAT = 2000
+
+
+def make_questions(count):
+    questions = []
+    for i in range(count):
+        question = Question(
+            question='What is question number {} about?'.format(i),
+            answer='The answer to question {}'.format(i),
+            category=i % 6 + 1,
+            difficulty=i % 5 + 1)
+        question.id = i + 1
+        question.row_version = 1
+        questions.append(question)
+    return questions
+
+
+def main():
+    per_page = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    questions = make_questions(per_page)
+    categories = ['Science', 'Art', 'Geography', 'History',
+                  'Entertainment', 'Sports']
+    cache = FragmentCache()
+    app = Flask(__name__)
+
+    def format_and_jsonify():
+        return jsonify({
+            'success': True,
+            'questions': [question.format() for question in questions],
+            'total_questions': 1000,
+            'categories': categories,
+            'current_category': categories
+        }).get_data()
+
+    def cached_fragments():
+        return json_response({
+            'success': True,
+            'total_questions': 1000,
+            'categories': categories,
+            'current_category': categories
+        }, questions=cache.render(questions)).get_data()
+
+    with app.app_context():
+        cached_fragments()
+        baseline = min(timeit.repeat(
+            format_and_jsonify, number=REPEAT, repeat=5)) / REPEAT
+        cached = min(timeit.repeat(
+            cached_fragments, number=REPEAT, repeat=5)) / REPEAT
+
+    print('questions per page    {}'.format(per_page))
+    print('json backend          {}'.format('orjson' if orjson else 'json'))
+    print('format() + jsonify    {:8.1f} us'.format(baseline * 1e6))
+    print('cached fragments      {:8.1f} us'.format(cached * 1e6))
+    print('speedup               {:8.1f}x'.format(baseline / cached))
+
+
+if __name__ == '__main__':
+    main()
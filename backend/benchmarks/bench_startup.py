@@ -0,0 +1,97 @@
+'''
+Benchmark of the cold start of the app: the time a new process takes
+from the first import to an app ready to answer, and then to answer its
+first request.
+
+    python benchmarks/bench_startup.py [--budget 500] [--database URI]
+
+Each run is a fresh interpreter, as for a new instance scaled out or a
+serverless function. create_app() must not connect to the database, the
+engine is created by the first request, and the schema is migrated
+beforehand by 'flask db upgrade'. Exits with 1 when the median time to
+ready is over --budget milliseconds, or when create_app() connected.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run in each fresh interpreter, prints its timings as JSON
+COLD_START = '''
+import json, sys, time
+started = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+app = create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1]})
+ready = time.perf_counter()
+connected = bool(app.extensions['sqlalchemy'].connectors)
+status = app.test_client().get('/categories').status_code
+answered = time.perf_counter()
+print(json.dumps({
+    'import': imported - started,
+    'create_app': ready - imported,
+    'first_request': answered - ready,
+    'connected': connected,
+    'status': status}))
+'''
+
+
+def migrate(uri):
+    sys.path.insert(0, BACKEND)
+    from flaskr import create_app
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    result = app.test_cli_runner().invoke(args=['db', 'upgrade'])
+    if result.exit_code:
+        sys.exit(result.output)
+
+
+def cold_start(uri):
+    output = subprocess.check_output(
+        [sys.executable, '-c', COLD_START, uri], cwd=BACKEND)
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database', help='URI of an existing database')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=500.0,
+                        help='milliseconds from the import to create_app()')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    uri = args.database or 'sqlite:///' + os.path.join(directory, 'bench.db')
+    migrate(uri)
+
+    runs = [cold_start(uri) for _ in range(args.runs)]
+    print(json.dumps({key: value for key, value in vars(args).items()
+                      if key != 'database'}))
+    for name in ('import', 'create_app', 'first_request'):
+        print('{:<14} p50 {:>7.1f} ms   max {:>7.1f} ms'.format(
+            name, statistics.median(run[name] for run in runs) * 1e3,
+            max(run[name] for run in runs) * 1e3))
+    ready = statistics.median(
+        run['import'] + run['create_app'] for run in runs) * 1e3
+    print('ready          p50 {:>7.1f} ms   budget {:.0f} ms'.format(
+        ready, args.budget))
+
+    failures = []
+    if any(run['connected'] for run in runs):
+        failures.append('create_app() connected to the database')
+    if any(run['status'] >= 500 for run in runs):
+        failures.append('the first request failed')
+    if ready > args.budget:
+        failures.append('over the budget')
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
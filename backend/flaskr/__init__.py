@@ -1,30 +1,89 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import (
+    Flask, Response, request, abort, jsonify, stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
-
-from models import setup_db, Question, Category
-
-QUESTIONS_PER_PAGE = 10
-
-
-def paginate_questions(request, selection):
-    page = request.args.get('page', 1, type=int)
-
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
-
-    return current_questions
+from itsdangerous import BadSignature, URLSafeSerializer
+from werkzeug.exceptions import BadRequest
+
+from config import SECRET_KEY
+from migrations import db_cli
+from models import db, database_path, setup_db, Question, Category
+from pool import (
+    MAX_OVERFLOW, POOL_PRE_PING, POOL_RECYCLE, POOL_SIZE, POOL_TIMEOUT,
+    pool_stats)
+from routing import (
+    READ_YOUR_WRITES, read_your_writes, replica_reads, use_replica)
+from .pagination import get_per_page, paginate_questions, seek_questions
+from .bulk import (
+    BULK_CHUNK_SIZE, EXPORT_MIMETYPES, MAX_DIFFICULTY, MIN_DIFFICULTY,
+    bulk_delete, bulk_update, criteria, export_questions, import_format,
+    import_questions, indexed_questions, last_question_id, update_question)
+from .cache import bank_version, category_cache, conditional
+from .compression import (
+    COMPRESSION_CACHE_SIZE, COMPRESSION_LEVEL, COMPRESSION_THRESHOLD,
+    CompressionMiddleware)
+from .quiz import (
+    question_pool, seeded_domain, seeded_questions, select_questions)
+from .sharding import get_question, shards
+from .serialization import (
+    fragment_cache, get_fields, json_response, render_questions,
+    select_fields)
+from .search import (
+    FUZZY_THRESHOLD, fuzzy_search_questions, search_index, search_questions,
+    trigram_index)
+from .sessions import SESSION_TTL, create_session_store, shuffled_deck
+from .validation import (
+    get_new_question, get_quiz_category_id, get_quiz_count, is_integer)
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    app.config.from_mapping(
+        # workers behind a load balancer must share the secret key,
+        # it signs the quiz deck tokens
+        SECRET_KEY=os.environ.get('TRIVIA_SECRET_KEY', SECRET_KEY),
+        QUIZ_SESSION_STORE='memory',
+        QUIZ_SESSION_TTL=SESSION_TTL,
+        SEARCH_BACKEND='memory',
+        COMPRESSION_THRESHOLD=COMPRESSION_THRESHOLD,
+        COMPRESSION_LEVEL=COMPRESSION_LEVEL,
+        COMPRESSION_CACHE_SIZE=COMPRESSION_CACHE_SIZE,
+        BULK_CHUNK_SIZE=BULK_CHUNK_SIZE,
+        # 'queue', or 'null' behind an external pooler
+        DB_POOL='queue',
+        DB_POOL_SIZE=POOL_SIZE,
+        DB_MAX_OVERFLOW=MAX_OVERFLOW,
+        DB_POOL_TIMEOUT=POOL_TIMEOUT,
+        DB_POOL_PRE_PING=POOL_PRE_PING,
+        DB_POOL_RECYCLE=POOL_RECYCLE,
+        # URIs of read replicas of the database
+        DB_REPLICAS=[],
+        # URIs of the databases the questions are spread over, by
+        # category
+        DB_SHARDS=[],
+        READ_YOUR_WRITES=READ_YOUR_WRITES)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    # the ASGI app of flaskr/asgi.py reads the same setting
+    # nothing connects before the first request, the schema and the
+    # categories of the shards are set up by 'flask db upgrade'
+    setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI', database_path))
+    # 'flask db upgrade'
+    app.cli.add_command(db_cli)
+
+    # gzip/deflate responses for clients which accept them
+    compression = CompressionMiddleware(
+        app.wsgi_app,
+        threshold=app.config['COMPRESSION_THRESHOLD'],
+        level=app.config['COMPRESSION_LEVEL'],
+        cache_size=app.config['COMPRESSION_CACHE_SIZE'])
+    app.wsgi_app = compression
+
+    quiz_sessions = create_session_store(
+        app.config['QUIZ_SESSION_STORE'], app.config['QUIZ_SESSION_TTL'])
+    app.extensions['quiz_sessions'] = quiz_sessions
 
     '''
   @TODO-DONE: Set up CORS. Allow '*' for origins.
@@ -39,11 +98,12 @@ def create_app(test_config=None):
     def after_request(response):
         response.headers.add(
             'Access-Control-Allow-Headers',
-            'Content-Type,Authorization,True')
+            'Content-Type,Authorization,Prefer,True')
         response.headers.add(
             'Access-Control-Allow-Methods',
             'GET, POST, PATCH, DELETE, OPTIONS')
-        return response
+        # a client which wrote reads from the primary for a moment
+        return read_your_writes(response)
 
         '''
   @TODO-DONE:
@@ -52,15 +112,15 @@ def create_app(test_config=None):
   '''
 
     @app.route('/categories', methods=['GET'])
+    @replica_reads
+    @conditional
     def get_categories():
-        categories = Category.query.all()
+        all_categories = category_cache.types()
 
         # if no category found
-        if not categories:
+        if not all_categories:
             abort(404)
 
-        all_categories = [category.format()['type'] for category in categories]
-
         # return success response with list of categories
         return jsonify({
             'success': True,
@@ -82,25 +142,39 @@ def create_app(test_config=None):
   '''
 
     @app.route('/questions', methods=['GET'])
+    @replica_reads
+    @conditional
     def get_questions():
-        selection = Question.query.order_by(Question.id).all()
-        current_questions = paginate_questions(request, selection)
+        # only the requested columns are selected
+        fields = get_fields(request)
+        selection = select_fields(
+            Question.query.order_by(Question.id), fields)
+
+        # 'cursor' in the query string opts in to keyset pagination
+        if 'cursor' in request.args:
+            current_questions, pagination = seek_questions(
+                request, selection)
+        else:
+            current_questions, total_questions = paginate_questions(
+                request, selection)
+            pagination = {'total_questions': total_questions}
 
         # if there is no question present
         if len(current_questions) == 0:
             abort(404)
 
-        categories = Category.query.all()
-        all_categories = [category.format()['type'] for category in categories]
+        all_categories = category_cache.types()
 
-        # return success response
-        return jsonify({
+        # return success response, the questions are joined from
+        # their cached JSON
+        response = {
             'success': True,
-            'questions': current_questions,
-            'total_questions': len(selection),
             'categories': all_categories,
             'current_category': all_categories
-        })
+        }
+        response.update(pagination)
+        return json_response(response, questions=render_questions(
+            current_questions, fields))
 
     '''
   @TODO-DONE:
@@ -112,27 +186,113 @@ def create_app(test_config=None):
   refresh the page.
   '''
 
+    def prefers_representation():
+        # write endpoints answer with only the id and the new version
+        # unless the client sends 'Prefer: return=representation'
+        preferences = request.headers.get('Prefer', '').replace(';', ',')
+        return 'return=representation' in [
+            preference.strip().lower()
+            for preference in preferences.split(',')]
+
+    def write_response(representation, **minimal):
+        if representation is None:
+            response = jsonify(dict(success=True, **minimal))
+            response.headers['Preference-Applied'] = 'return=minimal'
+        else:
+            response = representation()
+            response.headers['Preference-Applied'] = \
+                'return=representation'
+        return response
+
+    def update_indexes(version, removed=(), questions=()):
+        # applies a write of this request to the in-process indexes
+        # and quiz pool, which would otherwise be rebuilt for 'version'
+        for index in (search_index, trigram_index, question_pool):
+            index.update(version, removed, questions)
+
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
     def remove_question(question_id):
-        # get question from with question_id from database
-        question = Question.query.filter(
-            Question.id == question_id).one_or_none()
+        try:
+            # delete the question with a single statement
+            deleted, _ = bulk_delete(criteria([question_id]))
+        except BaseException:
+            abort(422)
 
         # if question does not exist
-        if not question:
+        if not deleted:
             abort(404)
 
+        version = bank_version.bump()
+        update_indexes(version, removed=[question_id])
+
+        # return success response
+        return jsonify({
+            'success': True,
+            'deleted': question_id
+        })
+
+    def get_question_changes(body):
+        # the supplied fields of a question, validated
+        changes = {key: value for key, value in body.items()
+                   if key != 'row_version'}
+        if not changes or set(changes) - {
+                'question', 'answer', 'category', 'difficulty'}:
+            abort(400)
+        for key in ('question', 'answer'):
+            if key in changes and (not isinstance(changes[key], str) or
+                                   not changes[key].strip()):
+                abort(400)
+        if 'category' in changes and (
+                not is_integer(changes['category']) or
+                changes['category'] not in category_cache.type_map()):
+            abort(400)
+        if 'category' in changes and shards.enabled:
+            # would move the question to another shard
+            abort(422)
+        if 'difficulty' in changes and (
+                not is_integer(changes['difficulty']) or
+                not MIN_DIFFICULTY <= changes['difficulty'] <=
+                MAX_DIFFICULTY):
+            abort(400)
+        return changes
+
+    @app.route('/questions/<int:question_id>', methods=['PATCH'])
+    def patch_question(question_id):
+        body = request.get_json()
+        if not body or not isinstance(body, dict):
+            abort(400)
+        changes = get_question_changes(body)
+        row_version = body.get('row_version')
+        if row_version is not None and not is_integer(row_version):
+            abort(400)
+
         try:
-            # delete and reflect changes to database
-            question.delete()
+            row = update_question(question_id, changes, row_version)
+        except BaseException:
+            abort(422)
 
-            # return success response
+        if row is None:
+            exists = get_question(question_id)
+            # the question was changed since 'row_version'
+            abort(409 if exists is not None and row_version is not None
+                  else 404)
+
+        # the question is indexed again with its new text and category
+        version = bank_version.bump()
+        update_indexes(version, questions=[row])
+        question = dict(row)
+        row_version = question.pop('row_version')
+
+        def representation():
             return jsonify({
                 'success': True,
-                'deleted': question_id
+                'row_version': row_version,
+                'question': question
             })
-        except BaseException:
-            abort(422)
+
+        return write_response(
+            representation if prefers_representation() else None,
+            updated=question_id, row_version=row_version, version=version)
 
     '''
   @TODO-DONE:
@@ -165,6 +325,42 @@ def create_app(test_config=None):
             abort(400)
 
         to_search = body.get('searchTerm', None)
+        search_mode = body.get('mode', 'substring')
+
+        if to_search:
+            # searches only read
+            use_replica()
+        # search results can be narrowed to some fields
+        fields = get_fields(request) if to_search else None
+        if to_search and search_mode in ('ranked', 'fuzzy'):
+            page = request.args.get('page', 1, type=int)
+            selection = select_fields(Question.query, fields)
+            if search_mode == 'ranked':
+                # multi-term full text search ranked with BM25,
+                # over question and answer text
+                questions, total_questions = search_questions(
+                    to_search, page, get_per_page(request), selection)
+            else:
+                # questions containing the search term, then the ones
+                # similar to it by their shared trigrams
+                threshold = body.get('threshold', FUZZY_THRESHOLD)
+                if isinstance(threshold, bool) or \
+                        not isinstance(threshold, (int, float)) or \
+                        not 0 < threshold <= 1:
+                    abort(400)
+                questions, total_questions = fuzzy_search_questions(
+                    to_search, page, get_per_page(request), threshold,
+                    selection)
+
+            # if there are no such questions
+            if not total_questions:
+                abort(404)
+
+            return json_response({
+                'success': True,
+                'total_questions': total_questions,
+                'current_category': category_cache.types()
+            }, questions=render_questions(questions, fields))
 
         if to_search:
             # if request contains search term then search question
@@ -174,70 +370,206 @@ def create_app(test_config=None):
             # ex -> if 'to_search' == 'title' then it will returns
             # questions which contains words like
             # title, entitled ...
-            questions = Question.query.filter(
-                Question.question.ilike(f'%{to_search}%')).all()
+            questions = select_fields(Question.query.filter(
+                Question.question.ilike(f'%{to_search}%')).order_by(
+                Question.id), fields)
+
+            # if found questions then format them
+            all_questions, total_questions = paginate_questions(
+                request, questions)
 
             # if there are no such questions
-            if not questions:
+            if not total_questions:
                 abort(404)
 
-            # if found questions then format them
-            all_questions = paginate_questions(request, questions)
-
             # required for response
-            categories = Category.query.all()
-            all_categories = [category.format()['type']
-                              for category in categories]
+            all_categories = category_cache.types()
 
             # return success response
             # returns total_questions as total no of questions with searchTerm
-            return jsonify({
+            return json_response({
                 'success': True,
-                'questions': all_questions,
-                'total_questions': len(questions),
+                'total_questions': total_questions,
                 'current_category': all_categories
-            })
-
-        new_question_text = body.get('question', None)
-        new_answer_text = body.get('answer', None)
-        new_question_category = body.get('category', None)
-        new_question_difficulty = body.get('difficulty', None)
+            }, questions=render_questions(all_questions, fields))
 
         # check all requirements are full-filled
-        if not new_question_text:
-            abort(400)
-        if not new_answer_text:
-            abort(400)
-        if not new_question_category:
-            abort(400)
-        if not new_question_difficulty:
-            abort(400)
+        values = get_new_question(body)
 
         try:
 
-            question = Question(
-                question=new_question_text,
-                answer=new_answer_text,
-                category=new_question_category,
-                difficulty=new_question_difficulty)
+            question = Question(**values)
 
             # if all ok then insert the question and reflect the changes to
             # database
-            question.insert()
+            if shards.enabled:
+                # on the shard of its category
+                question.id, = shards.insert([question.format()])
+                question.row_version = 1
+            else:
+                question.insert()
+            version = bank_version.bump()
+            update_indexes(version, questions=[question])
+        except BaseException:
+            abort(422)
 
-            # get all questions after insertion
-            selections = Question.query.order_by(Question.id).all()
-            all_questions = paginate_questions(request, selections)
+        def representation():
+            # get the requested page of questions after insertion
+            selections = Question.query.order_by(Question.id)
+            all_questions, total_questions = paginate_questions(
+                request, selections)
 
             # return success response
-            return jsonify({
+            return json_response({
                 'success': True,
                 'created': question.id,
-                'questions': all_questions,
-                'total_questions': len(selections)
-            })
+                'total_questions': total_questions
+            }, questions=render_questions(all_questions))
+
+        return write_response(
+            representation if prefers_representation() else None,
+            created=question.id, version=version)
+
+    @app.route('/questions/bulk', methods=['POST'])
+    def import_bulk_questions():
+        # imports many questions from an NDJSON, CSV or Open Trivia DB
+        # JSON body, read as a stream and inserted in chunks
+        format_name = import_format(request)
+        if format_name is None:
+            abort(400)
+
+        # category ids and lower case types, both mapped to the id
+        categories = {}
+        for category_id, category_type in category_cache.type_map().items():
+            categories[category_id] = category_id
+            categories[category_type.lower()] = category_id
+
+        # the imported questions are the ones after the last id
+        last_id = last_question_id()
+        imported, errors = import_questions(
+            request.stream, format_name, categories,
+            app.config['BULK_CHUNK_SIZE'])
+        if not imported and not errors:
+            abort(400)
+
+        if imported:
+            # one version for the whole import
+            version = bank_version.bump()
+            update_indexes(version, questions=indexed_questions(
+                after=last_id))
+
+        return jsonify({
+            'success': True,
+            'imported': imported,
+            'failed': len(errors),
+            'errors': errors
+        })
+
+    @app.route('/questions/export', methods=['GET'])
+    def export_bulk_questions():
+        # streams all questions, or those of 'category' or after
+        # 'since_id', as NDJSON or CSV
+        format_name = request.args.get('format', 'ndjson')
+        if format_name not in EXPORT_MIMETYPES:
+            abort(400)
+        try:
+            category = request.args.get('category')
+            category = int(category) if category is not None else None
+            since_id = request.args.get('since_id')
+            since_id = int(since_id) if since_id is not None else None
+        except ValueError:
+            abort(400)
+
+        # the shards to read are looked up in the app context
+        response = Response(
+            stream_with_context(
+                export_questions(format_name, category, since_id)),
+            mimetype=EXPORT_MIMETYPES[format_name])
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=questions.{}'.format(format_name)
+        return response
+
+    def get_bulk_criteria(body):
+        # the questions a bulk write applies to, by 'ids' and/or by
+        # 'filter' on category and difficulty
+        ids = body.get('ids')
+        question_filter = body.get('filter', {})
+        if ids is not None and (
+                not isinstance(ids, list) or not ids or
+                not all(is_integer(question_id) for question_id in ids)):
+            abort(400)
+        if not isinstance(question_filter, dict) or \
+                set(question_filter) - {'category', 'difficulty'} or \
+                not all(is_integer(value)
+                        for value in question_filter.values()):
+            abort(400)
+        # never every question at once
+        if ids is None and not question_filter:
+            abort(400)
+        return criteria(ids, **question_filter)
+
+    @app.route('/questions/bulk-delete', methods=['POST'])
+    def delete_bulk_questions():
+        body = request.get_json()
+        if not body:
+            abort(400)
+        where = get_bulk_criteria(body)
+
+        try:
+            # one DELETE for all the questions
+            deleted, ids = bulk_delete(where)
         except BaseException:
             abort(422)
+        if not deleted:
+            abort(404)
+
+        version = bank_version.bump()
+        update_indexes(version, removed=ids)
+        return jsonify({
+            'success': True,
+            'deleted': deleted,
+            'ids': ids
+        })
+
+    @app.route('/questions/bulk', methods=['PATCH'])
+    def update_bulk_questions():
+        body = request.get_json()
+        if not body:
+            abort(400)
+        where = get_bulk_criteria(body)
+
+        # the new category and/or difficulty
+        values = body.get('set')
+        if not isinstance(values, dict) or not values or \
+                set(values) - {'category', 'difficulty'} or \
+                not all(is_integer(value) for value in values.values()):
+            abort(400)
+        if 'category' in values and \
+                values['category'] not in category_cache.type_map():
+            abort(400)
+        if 'category' in values and shards.enabled:
+            abort(422)
+        if 'difficulty' in values and \
+                not MIN_DIFFICULTY <= values['difficulty'] <= MAX_DIFFICULTY:
+            abort(400)
+
+        try:
+            # one UPDATE for all the questions
+            updated, ids = bulk_update(where, values)
+        except BaseException:
+            abort(422)
+        if not updated:
+            abort(404)
+
+        # the text is unchanged, the quiz pool needs the new category
+        version = bank_version.bump()
+        update_indexes(version, questions=indexed_questions(ids)
+                       if 'category' in values else ())
+        return jsonify({
+            'success': True,
+            'updated': updated,
+            'ids': ids
+        })
 
     '''
   @TODO-DONE:
@@ -249,24 +581,35 @@ def create_app(test_config=None):
   '''
 
     @app.route('/categories/<string:category_id>/questions', methods=['GET'])
+    @replica_reads
+    @conditional
     def get_question_by_category(category_id):
-        selections = Question.query.filter(
+        fields = get_fields(request)
+        selections = select_fields(Question.query.filter(
             Question.category == int(category_id)).order_by(
-            Question.id).all()
+            Question.id), fields)
+
+        # keyset pagination seeks on (category, id)
+        if 'cursor' in request.args:
+            all_questions, pagination = seek_questions(
+                request, selections, category=int(category_id))
+        else:
+            all_questions, total_questions = paginate_questions(
+                request, selections, category=int(category_id))
+            pagination = {'total_questions': total_questions}
 
         # if no questions with this category id found
-        if not selections:
+        if not all_questions and not pagination.get('total_questions'):
             abort(404)
 
-        all_questions = paginate_questions(request, selections)
-
         # return success response
-        return jsonify({
+        response = {
             'success': True,
-            'questions': all_questions,
-            'total_questions': len(selections),
             'current_category': category_id
-        })
+        }
+        response.update(pagination)
+        return json_response(
+            response, questions=render_questions(all_questions, fields))
 
     '''
   @EXTENDED-DONE:
@@ -292,19 +635,26 @@ def create_app(test_config=None):
             # insert new category
             new_category = Category(type=category_type)
             new_category.insert()
+            if shards.enabled:
+                shards.copy_category(new_category)
+            version = bank_version.bump()
+        except BaseException:
+            abort(422)
 
+        def representation():
             # get all categories and update on view
-            selections = Category.query.order_by(Category.id).all()
-            all_categories = [category.format() for category in selections]
+            all_categories = category_cache.categories()
             # return success response
             return jsonify({
                 'success': True,
                 'created': new_category.id,
                 'categories': all_categories,
-                'total_categories': len(selections)
+                'total_categories': len(all_categories)
             })
-        except BaseException:
-            abort(422)
+
+        return write_response(
+            representation if prefers_representation() else None,
+            created=new_category.id, version=version)
 
     '''
   @EXTENDED-DONE:
@@ -323,7 +673,12 @@ def create_app(test_config=None):
 
         try:
             # delete found category and reflect changes to database
+            if shards.enabled:
+                shards.delete_category(category)
+            # its questions get a new row_version, so every worker
+            # encodes them again
             category.delete()
+            bank_version.bump()
 
             # return success response
             return jsonify({
@@ -345,35 +700,160 @@ def create_app(test_config=None):
   and shown whether they were correct or not.
   '''
 
+    deck_tokens = URLSafeSerializer(app.config['SECRET_KEY'],
+                                    salt='quiz-deck')
+
+    def quiz_response(body, questions, **extra):
+        # 'question' is kept for single question clients, 'questions'
+        # is only sent to clients which asked for a 'count'
+        response = {
+            'success': True,
+            'question': questions[0].format() if questions else None
+        }
+        if 'count' in body:
+            response['questions'] = [
+                question.format() for question in questions]
+        response.update(extra)
+        return jsonify(response)
+
+    def play_seeded_quiz(body):
+        # the deck is derived from seed, category and the questions of
+        # the category when the quiz started, the signed token carries
+        # them with the position of the next question
+        try:
+            if 'token' in body:
+                deck = deck_tokens.loads(body['token'])
+                seed, category_id, position, domain = \
+                    deck['seed'], deck['category'], deck['position'], \
+                    deck['domain']
+            else:
+                seed = body['seed']
+                category_id = get_quiz_category_id(body)
+                position = int(body.get('position', 0))
+                domain = seeded_domain(category_id)
+        except (BadSignature, TypeError, KeyError, ValueError):
+            abort(400)
+
+        if not isinstance(seed, (int, str)) or position < 0:
+            abort(400)
+
+        questions, position = seeded_questions(
+            category_id, seed, position, domain, get_quiz_count(body))
+
+        return quiz_response(
+            body, questions,
+            position=position,
+            token=deck_tokens.dumps({
+                'seed': seed,
+                'category': category_id,
+                'position': position,
+                'domain': domain
+            }))
+
     @app.route('/quizzes', methods=['POST'])
     def play_quiz():
         body = request.get_json()
+        if not body:
+            abort(400)
+
+        # stateless mode, the client carries a seed or a deck token
+        # instead of previous_questions
+        if 'seed' in body or 'token' in body:
+            return play_seeded_quiz(body)
+
         if not ('quiz_category' in body and 'previous_questions' in body):
             abort(400)
+        count = get_quiz_count(body)
         try:
-            category = body.get('quiz_category')
             previous_questions = body.get('previous_questions')
+            category_id = get_quiz_category_id(body)
 
-            if category['type'] == 'click':
-                available_questions = Question.query.filter(
-                    Question.id.notin_((previous_questions))).all()
-            else:
-                available_questions = Question.query.filter_by(
-                    category=category['id']).filter(
-                    Question.id.notin_(
-                        (previous_questions))).all()
-
-            new_question = available_questions[random.randrange(
-                0, len(available_questions))].format() if
-            len(available_questions) > 0 else None
+            questions = select_questions(
+                category_id, previous_questions, count)
 
-            return jsonify({
-                'success': True,
-                'question': new_question
-            })
+            return quiz_response(body, questions)
         except BaseException:
             abort(422)
 
+    '''
+  Server side quiz sessions.
+  A session is created for a quiz category with a shuffled deck of its
+  question ids, each call to next pops one question off the deck, so the
+  client does not have to send the questions it already played.
+  '''
+
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def create_quiz_session():
+        body = request.get_json()
+        if not body or 'quiz_category' not in body:
+            abort(400)
+
+        try:
+            category_id = get_quiz_category_id(body)
+        except (TypeError, KeyError, ValueError):
+            abort(400)
+
+        deck = shuffled_deck(question_pool.ids(category_id))
+        session = quiz_sessions.create(category_id, deck)
+
+        return jsonify({
+            'success': True,
+            'session_id': session.id,
+            'total_questions': len(deck),
+            'expires_in': quiz_sessions.ttl
+        })
+
+    @app.route('/quizzes/sessions/<string:session_id>/next',
+               methods=['POST'])
+    def next_quiz_question(session_id):
+        while True:
+            remaining, question_id = quiz_sessions.draw(session_id)
+
+            # if session does not exist or has expired
+            if remaining is None:
+                abort(404)
+
+            if question_id is None:
+                question = None
+                break
+
+            # skip questions deleted since the deck was dealt
+            question = get_question(question_id)
+            if question is not None:
+                break
+
+        return jsonify({
+            'success': True,
+            'question': question.format() if question else None,
+            'remaining': remaining
+        })
+
+    '''
+  Endpoint reporting the hit and miss counters of the
+  in-process caches.
+  '''
+
+    @app.route('/admin/cache', methods=['GET'])
+    def get_cache_stats():
+        return jsonify({
+            'success': True,
+            'caches': {
+                'categories': category_cache.stats(),
+                'quiz_pool': question_pool.stats(),
+                'search_index': search_index.stats(),
+                'trigram_index': trigram_index.stats(),
+                'compression': compression.stats(),
+                'fragments': fragment_cache.stats()
+            }
+        })
+
+    @app.route('/admin/pool', methods=['GET'])
+    def get_pool_stats():
+        return jsonify({
+            'success': True,
+            'pool': pool_stats(db.engine)
+        })
+
     '''
   @TODO-DONE:
   Create error handlers for all expected errors
@@ -382,11 +862,15 @@ def create_app(test_config=None):
 
     @app.errorhandler(400)
     def bad_request(error):
-        return jsonify({
+        body = {
             'success': False,
             'error': 400,
             'message': 'bad request'
-        }), 400
+        }
+        # aborts which tell the client how to fix its request
+        if error.description != BadRequest.description:
+            body['hint'] = error.description
+        return jsonify(body), 400
 
     @app.errorhandler(404)
     def not_found(error):
@@ -404,6 +888,14 @@ def create_app(test_config=None):
             'message': 'method not allowed'
         }), 405
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            'success': False,
+            'error': 409,
+            'message': 'conflict'
+        }), 409
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
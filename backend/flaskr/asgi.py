@@ -0,0 +1,521 @@
+import asyncio
+import datetime
+import json
+import random
+import re
+import time
+from urllib.parse import parse_qsl
+
+from sqlalchemy import func, select, update
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException, abort
+
+from models import database_path, Category, Question, QuestionBank
+from pool import MAX_OVERFLOW, POOL_SIZE
+from .cache import CACHE_TTL
+from .pagination import get_per_page
+from .quiz import draw_id, group_ids
+from .serialization import (
+    QUESTION_FIELDS, dumps, get_fields, json_body, render_questions)
+from .validation import (
+    get_new_question, get_quiz_category_id, get_quiz_count)
+
+try:
+    # async database driver, on asyncpg for Postgres and aiosqlite for
+    # SQLite
+    import databases
+except ImportError:
+    databases = None
+
+'''
+ASGI app
+    an asyncio variant of the API for quiz traffic with many players
+    per process: a request waiting on the database holds a coroutine
+    instead of a worker thread. It serves the routes of the hot path
+    with the JSON of the Flask app, and shares its models, validation
+    and serialization:
+
+        GET    /categories
+        GET    /questions
+        GET    /categories/<category_id>/questions
+        POST   /questions              create, or substring search
+        DELETE /questions/<question_id>
+        POST   /quizzes                with previous_questions
+
+    Everything else, and the features not listed (cursors, ranked and
+    fuzzy search, seeded quizzes, replicas and shards), is served by the
+    Flask app. Queries are built with SQLAlchemy Core on the tables of
+    the models and run by the 'databases' package. The schema comes
+    from 'flask db upgrade'.
+
+    Run it with an ASGI server:
+
+        uvicorn --factory flaskr.asgi:create_asgi_app
+'''
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'resource not found',
+    405: 'method not allowed',
+    409: 'conflict',
+    422: 'unprocessable',
+    500: 'internal server error'
+}
+
+CORS_HEADERS = [
+    (b'access-control-allow-headers',
+     b'Content-Type,Authorization,Prefer,True'),
+    (b'access-control-allow-methods',
+     b'GET, POST, PATCH, DELETE, OPTIONS')
+]
+
+
+class Request(object):
+    # what the shared helpers read from Flask's request
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = MultiDict(parse_qsl(
+            scope.get('query_string', b'').decode('latin-1'),
+            keep_blank_values=True))
+        self.headers = {name.decode('latin-1').lower(): value.decode(
+            'latin-1') for name, value in scope.get('headers', [])}
+        self.body = body
+
+    def get_json(self):
+        if not self.body:
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            abort(400)
+
+    def prefers_representation(self):
+        preferences = self.headers.get('prefer', '').replace(';', ',')
+        return 'return=representation' in [
+            preference.strip().lower()
+            for preference in preferences.split(',')]
+
+
+class Response(object):
+
+    def __init__(self, body, status=200, headers=None):
+        self.body = body
+        self.status = status
+        self.headers = headers or []
+
+
+def json_response(payload, status=200, **fragments):
+    return Response(json_body(payload, **fragments), status)
+
+
+def error_response(status):
+    return json_response({
+        'success': False,
+        'error': status,
+        'message': ERROR_MESSAGES.get(status, 'error')
+    }, status)
+
+
+def question_from_row(row):
+    # a detached question, the columns which were not selected are None
+    values = dict.fromkeys(QUESTION_FIELDS)
+    values.update((key, row[key]) for key in row.keys())
+    return Question.from_row(values)
+
+
+'''
+AsyncCache
+    an entry loaded with an async 'loader', reloaded after CACHE_TTL
+    seconds or once this process wrote to the bank. Writes of other
+    processes are seen within CACHE_TTL.
+'''
+
+
+class AsyncCache(object):
+
+    def __init__(self, loader, ttl=CACHE_TTL):
+        self.loader = loader
+        self.ttl = ttl
+        self._entry = None
+        self._loaded_at = 0
+        self._lock = asyncio.Lock()
+
+    async def get(self):
+        if self._entry is not None and \
+                time.monotonic() - self._loaded_at < self.ttl:
+            return self._entry
+        async with self._lock:
+            # another request may have reloaded while we were waiting
+            if self._entry is None or \
+                    time.monotonic() - self._loaded_at >= self.ttl:
+                self._entry = await self.loader()
+                self._loaded_at = time.monotonic()
+            return self._entry
+
+    def clear(self):
+        self._entry = None
+
+
+'''
+TriviaASGI
+    the app, create it with create_asgi_app(). Views are coroutines
+    taking the Request and the parameters of their route, they return a
+    Response or abort() like the views of the Flask app.
+'''
+
+
+class TriviaASGI(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.database = create_database(config)
+        self._connect_lock = asyncio.Lock()
+        self.categories = AsyncCache(self.load_categories)
+        self.pool = AsyncCache(self.load_pool)
+        self.routes = []
+        self.route('GET', r'/categories', self.get_categories)
+        self.route('GET', r'/questions', self.get_questions)
+        self.route('POST', r'/questions', self.create_question)
+        self.route('DELETE', r'/questions/(?P<question_id>\d+)',
+                   self.remove_question)
+        self.route('GET', r'/categories/(?P<category_id>\d+)/questions',
+                   self.get_question_by_category)
+        self.route('POST', r'/quizzes', self.play_quiz)
+
+    def route(self, method, pattern, view):
+        self.routes.append((method, re.compile(pattern + '$'), view))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        response = await self.dispatch(Request(scope, body))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(response.body)).encode())
+            ] + CORS_HEADERS + response.headers
+        })
+        await send({'type': 'http.response.body', 'body': response.body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.database.disconnect()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def connect(self):
+        # servers without lifespan events connect on the first request
+        async with self._connect_lock:
+            if not self.database.is_connected:
+                await self.database.connect()
+
+    async def dispatch(self, request):
+        allowed = False
+        for method, pattern, view in self.routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            if method != request.method:
+                allowed = True
+                continue
+            try:
+                if not self.database.is_connected:
+                    await self.connect()
+                return await view(request, **match.groupdict())
+            except HTTPException as error:
+                return error_response(error.code)
+            except Exception:
+                return error_response(500)
+        return error_response(405 if allowed else 404)
+
+    async def load_categories(self):
+        table = Category.__table__
+        rows = await self.database.fetch_all(
+            select([table.c.id, table.c.type]).order_by(table.c.id))
+        return {
+            'types': [row['type'] for row in rows],
+            'type_map': {row['id']: row['type'] for row in rows}
+        }
+
+    async def load_pool(self):
+        table = Question.__table__
+        rows = await self.database.fetch_all(
+            select([table.c.id, table.c.category]).order_by(table.c.id))
+        return group_ids((row['id'], row['category']) for row in rows)
+
+    async def bump_version(self):
+        # like bank_version.bump(), the caches of the Flask workers see
+        # the write too
+        table = QuestionBank.__table__
+        now = datetime.datetime.utcnow()
+        async with self.database.transaction():
+            await self.database.execute(update(table).where(
+                table.c.id == 1).values(
+                version=table.c.version + 1, updated_at=now))
+            version = await self.database.fetch_val(
+                select([table.c.version]).where(table.c.id == 1))
+            if version is None:
+                # databases which were not migrated yet
+                version = 1
+                await self.database.execute(table.insert().values(
+                    id=1, version=version, updated_at=now))
+        self.categories.clear()
+        self.pool.clear()
+        return version
+
+    async def page(self, request, where=None, fields=None):
+        # (questions of the requested page, number of questions), only
+        # the columns of 'fields' are selected, see select_fields()
+        table = Question.__table__
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = get_per_page(request)
+        if fields is None:
+            rows = select([table])
+        else:
+            rows = select([table.c[field] for field in fields] +
+                          [table.c.row_version])
+        total = select([func.count()]).select_from(table)
+        if where is not None:
+            rows, total = rows.where(where), total.where(where)
+        rows = await self.database.fetch_all(rows.order_by(
+            table.c.id).limit(per_page).offset((page - 1) * per_page))
+        return [question_from_row(row) for row in rows], \
+            await self.database.fetch_val(total)
+
+    async def get_categories(self, request):
+        all_categories = (await self.categories.get())['types']
+        if not all_categories:
+            abort(404)
+        return json_response({
+            'success': True,
+            'categories': all_categories
+        })
+
+    async def get_questions(self, request):
+        fields = get_fields(request)
+        questions, total_questions = await self.page(request, fields=fields)
+        if not questions:
+            abort(404)
+
+        all_categories = (await self.categories.get())['types']
+        return json_response({
+            'success': True,
+            'categories': all_categories,
+            'current_category': all_categories,
+            'total_questions': total_questions
+        }, questions=render_questions(questions, fields))
+
+    async def get_question_by_category(self, request, category_id):
+        fields = get_fields(request)
+        questions, total_questions = await self.page(
+            request, Question.__table__.c.category == int(category_id),
+            fields)
+        if not questions and not total_questions:
+            abort(404)
+
+        return json_response({
+            'success': True,
+            'current_category': category_id,
+            'total_questions': total_questions
+        }, questions=render_questions(questions, fields))
+
+    async def create_question(self, request):
+        body = request.get_json()
+        if not body:
+            abort(400)
+
+        to_search = body.get('searchTerm')
+        if to_search:
+            if body.get('mode', 'substring') != 'substring':
+                # ranked and fuzzy search are served by the Flask app
+                abort(400)
+            fields = get_fields(request)
+            questions, total_questions = await self.page(
+                request, Question.__table__.c.question.ilike(
+                    '%{}%'.format(to_search)), fields)
+            if not total_questions:
+                abort(404)
+
+            return json_response({
+                'success': True,
+                'total_questions': total_questions,
+                'current_category': (await self.categories.get())['types']
+            }, questions=render_questions(questions, fields))
+
+        values = get_new_question(body)
+        statement = Question.__table__.insert().values(**values)
+        if self.database.url.dialect != 'sqlite':
+            # SQLite answers with the last row id by itself
+            statement = statement.returning(Question.__table__.c.id)
+        try:
+            question_id = await self.database.execute(statement)
+        except Exception:
+            abort(422)
+        version = await self.bump_version()
+
+        if not request.prefers_representation():
+            response = json_response({
+                'success': True,
+                'created': question_id,
+                'version': version
+            })
+            response.headers.append(
+                (b'preference-applied', b'return=minimal'))
+            return response
+
+        questions, total_questions = await self.page(request)
+        response = json_response({
+            'success': True,
+            'created': question_id,
+            'total_questions': total_questions
+        }, questions=render_questions(questions))
+        response.headers.append(
+            (b'preference-applied', b'return=representation'))
+        return response
+
+    async def remove_question(self, request, question_id):
+        # a single DELETE, the driver does not report its row count:
+        # Postgres returns the deleted id, SQLite counts the changes of
+        # the connection
+        table = Question.__table__
+        question_id = int(question_id)
+        statement = table.delete().where(table.c.id == question_id)
+        try:
+            if self.database.url.dialect == 'sqlite':
+                async with self.database.transaction():
+                    await self.database.execute(statement)
+                    deleted = await self.database.fetch_val(
+                        'SELECT changes()')
+            else:
+                deleted = await self.database.fetch_val(
+                    statement.returning(table.c.id))
+        except Exception:
+            abort(422)
+        if not deleted:
+            abort(404)
+
+        await self.bump_version()
+        return json_response({
+            'success': True,
+            'deleted': question_id
+        })
+
+    async def play_quiz(self, request):
+        body = request.get_json()
+        if not body:
+            abort(400)
+        if 'seed' in body or 'token' in body:
+            # seeded quizzes are served by the Flask app
+            abort(400)
+        if not ('quiz_category' in body and 'previous_questions' in body):
+            abort(400)
+        count = get_quiz_count(body)
+        try:
+            category_id = get_quiz_category_id(body)
+            questions = await self.select_questions(
+                category_id, body.get('previous_questions'), count)
+        except HTTPException:
+            raise
+        except Exception:
+            abort(422)
+
+        response = {
+            'success': True,
+            'question': questions[0].format() if questions else None
+        }
+        if 'count' in body:
+            response['questions'] = [
+                question.format() for question in questions]
+        return Response(dumps(response) + b'\n')
+
+    async def select_questions(self, category, previous_questions, count):
+        # like quiz.select_questions(): ids drawn from the in-memory
+        # pool, loaded in one query, random offsets in SQL past the pool
+        table = Question.__table__
+        pool = await self.pool.get()
+        ids = pool['all'] if category is None else \
+            pool['by_category'].get(category, ())
+        seen = set(previous_questions)
+        drawn = []
+        while len(drawn) < count:
+            question_id = draw_id(ids, seen)
+            if question_id is None:
+                break
+            seen.add(question_id)
+            drawn.append(question_id)
+
+        questions = []
+        if drawn:
+            rows = {row['id']: row for row in await self.database.fetch_all(
+                select([table]).where(table.c.id.in_(drawn)))}
+            for question_id in drawn:
+                row = rows.get(question_id)
+                # the pool may lag behind writes made by another process
+                if row is not None and (
+                        category is None or row['category'] is not None and
+                        int(row['category']) == category):
+                    questions.append(Question.from_row(row))
+
+        while len(questions) < count:
+            statement = select([table])
+            if category is not None:
+                statement = statement.where(table.c.category == category)
+            if seen:
+                statement = statement.where(table.c.id.notin_(seen))
+            total = await self.database.fetch_val(select(
+                [func.count()]).select_from(statement.alias()))
+            if not total:
+                break
+            row = await self.database.fetch_one(statement.order_by(
+                table.c.id).offset(random.randrange(total)).limit(1))
+            if row is None:
+                break
+            seen.add(row['id'])
+            questions.append(Question.from_row(row))
+
+        return questions
+
+
+def create_database(config):
+    if databases is None:
+        raise RuntimeError(
+            'the ASGI app needs the databases package, see '
+            'requirements-asgi.txt')
+    url = config['SQLALCHEMY_DATABASE_URI']
+    options = {}
+    if not url.startswith('sqlite'):
+        # the asyncpg pool, as large as the pool of a Flask worker
+        options.update(
+            min_size=config['DB_POOL_SIZE'],
+            max_size=config['DB_POOL_SIZE'] + config['DB_MAX_OVERFLOW'])
+    return databases.Database(url, **options)
+
+
+def create_asgi_app(test_config=None):
+    config = {
+        'SQLALCHEMY_DATABASE_URI': database_path,
+        'DB_POOL_SIZE': POOL_SIZE,
+        'DB_MAX_OVERFLOW': MAX_OVERFLOW
+    }
+    if test_config is not None:
+        config.update(test_config)
+    return TriviaASGI(config)
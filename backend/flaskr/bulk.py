@@ -0,0 +1,511 @@
+import codecs
+import csv
+import heapq
+import html
+import io
+import json
+from itertools import islice
+
+from sqlalchemy import and_, delete, select, update
+
+from models import db, Question
+from .serialization import dumps
+from .sharding import fetch, shards
+
+# rows inserted and committed together
+BULK_CHUNK_SIZE = 5000
+# bytes read from the request body at once
+READ_SIZE = 64 * 1024
+# rows fetched from the export cursor at once
+EXPORT_BATCH_SIZE = 1000
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+
+# difficulties of the Open Trivia DB
+OPENTDB_DIFFICULTIES = {'easy': 1, 'medium': 3, 'hard': 5}
+
+FORMATS = {
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'text/csv': 'csv',
+    'application/json': 'opentdb'
+}
+
+
+class RowError(ValueError):
+    # a row which cannot be imported, its message ends up in the report
+    pass
+
+
+def import_format(request):
+    # 'ndjson', 'csv' or 'opentdb', from ?format= or the content type
+    name = request.args.get('format')
+    if name is None:
+        name = FORMATS.get(request.mimetype)
+    return name if name in ('ndjson', 'csv', 'opentdb') else None
+
+
+'''
+Streaming parsers
+    each reads the body a chunk at a time and yields (row, record)
+    pairs, 'row' is the line (the position in the 'results' array for
+    Open Trivia DB files) and 'record' a dict or the RowError raised
+    while reading it. The body is never held in memory as a whole.
+'''
+
+
+def _text(stream):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+            return
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+
+
+def _lines(stream):
+    # lines ending with '\n' only: str.splitlines() also splits on
+    # separators like U+2028 which JSON strings may hold unescaped, and
+    # on a '\r\n' cut in two by the end of a chunk
+    pending = ''
+    for text in _text(stream):
+        lines = (pending + text).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def parse_ndjson(stream):
+    for row, line in enumerate(_lines(stream), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield row, RowError('invalid JSON')
+            continue
+        if not isinstance(record, dict):
+            yield row, RowError('expected an object')
+            continue
+        yield row, record
+
+
+def parse_csv(stream):
+    # the first line names the columns. The body is decoded like a file
+    # opened with newline='', as the csv module expects
+    text = io.TextIOWrapper(stream, encoding='utf-8', errors='replace',
+                            newline='')
+    reader = csv.DictReader(text)
+    try:
+        for record in reader:
+            yield reader.line_num, record
+    except csv.Error as error:
+        yield reader.line_num, RowError(str(error))
+    finally:
+        # the request stream is left open
+        text.detach()
+
+
+def parse_opentdb(stream):
+    # {"response_code": 0, "results": [{...}, ...]}, the objects of the
+    # results array are decoded one at a time as the body comes in
+    decoder = json.JSONDecoder()
+    chunks = _text(stream)
+    buffer = ''
+    start = None
+    row = 0
+
+    while start is None:
+        key = buffer.find('"results"')
+        if key != -1:
+            bracket = buffer.find('[', key)
+            if bracket != -1:
+                if buffer[key + 9:bracket].strip() != ':':
+                    raise RowError('invalid Open Trivia DB file')
+                start = bracket + 1
+                break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise RowError('no results in Open Trivia DB file')
+        buffer += chunk
+
+    buffer = buffer[start:]
+    position = 0
+    while True:
+        # skips the separators between two results
+        while True:
+            while position < len(buffer) and \
+                    buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer):
+                break
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise RowError('unterminated results array')
+            buffer, position = buffer[position:] + chunk, 0
+
+        if buffer[position] == ']':
+            return
+
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise RowError('invalid JSON in results array')
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+
+        row += 1
+        buffer, position = buffer[end:], 0
+        if not isinstance(record, dict):
+            yield row, RowError('expected an object')
+            continue
+        yield row, from_opentdb(record)
+
+
+PARSERS = {
+    'ndjson': parse_ndjson,
+    'csv': parse_csv,
+    'opentdb': parse_opentdb
+}
+
+
+def from_opentdb(record):
+    # Open Trivia DB escapes its text as HTML and names its categories
+    # like 'Science: Computers'
+    difficulty = record.get('difficulty')
+    return {
+        'question': html.unescape(record.get('question') or ''),
+        'answer': html.unescape(record.get('correct_answer') or ''),
+        'category': html.unescape(record.get('category') or ''),
+        'difficulty': OPENTDB_DIFFICULTIES.get(difficulty, difficulty)
+    }
+
+
+'''
+validate(record, categories)
+    returns the columns of the question to insert, raises RowError
+    when a field is missing or invalid. 'categories' maps both category
+    ids and lower case category types to the category id.
+'''
+
+
+def validate(record, categories):
+    question = record.get('question')
+    answer = record.get('answer')
+    if not isinstance(question, str) or not question.strip():
+        raise RowError('question is required')
+    if not isinstance(answer, str) or not answer.strip():
+        raise RowError('answer is required')
+
+    category = record.get('category')
+    if isinstance(category, str):
+        category = category.strip()
+        if category.isdigit():
+            category = int(category)
+        else:
+            name = category.lower()
+            # 'Science: Computers' goes to 'Science'
+            category = categories.get(
+                name, categories.get(name.split(':')[0].strip()))
+    if isinstance(category, bool) or category not in categories:
+        raise RowError('unknown category')
+
+    difficulty = record.get('difficulty')
+    if isinstance(difficulty, str) and difficulty.strip().isdigit():
+        difficulty = int(difficulty)
+    if isinstance(difficulty, bool) or not isinstance(difficulty, int) or \
+            not MIN_DIFFICULTY <= difficulty <= MAX_DIFFICULTY:
+        raise RowError('difficulty must be an integer from {} to {}'.format(
+            MIN_DIFFICULTY, MAX_DIFFICULTY))
+
+    return {
+        'question': question.strip(),
+        'answer': answer.strip(),
+        'category': categories[category],
+        'difficulty': difficulty
+    }
+
+
+COLUMNS = ('question', 'answer', 'category', 'difficulty')
+
+
+def _copy(rows):
+    # COPY of one chunk on Postgres, returns False when the driver
+    # cannot do it
+    cursor = db.session.connection().connection.cursor()
+    if not hasattr(cursor, 'copy_expert'):
+        return False
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for values in rows:
+        writer.writerow([values[column] for column in COLUMNS])
+    buffer.seek(0)
+    cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        Question.__tablename__, ', '.join(COLUMNS)), buffer)
+    return True
+
+
+def _insert(rows):
+    if shards.enabled:
+        shards.insert(rows)
+        return
+    if db.engine.dialect.name != 'postgresql' or not _copy(rows):
+        # one executemany for the whole chunk
+        db.session.execute(Question.__table__.insert(), rows)
+    db.session.commit()
+
+
+'''
+import_questions(stream, format_name, categories)
+    parses, validates and inserts the questions of 'stream', BULK_CHUNK_SIZE
+    rows per transaction. A chunk failing in the database is rolled back
+    and reported row by row, the chunks before it stay imported.
+    Returns (imported, errors), 'errors' is the list of
+    {'row': row, 'error': message} of the rows that were not imported.
+'''
+
+
+def import_questions(stream, format_name, categories, chunk_size=None):
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+    imported = 0
+    errors = []
+    chunk = []
+    chunk_rows = []
+
+    def flush():
+        try:
+            _insert(chunk)
+        except Exception:
+            db.session.rollback()
+            errors.extend({'row': row, 'error': 'rejected by the database'}
+                          for row in chunk_rows)
+            return 0
+        return len(chunk)
+
+    try:
+        for row, record in PARSERS[format_name](stream):
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                values = validate(record, categories)
+            except RowError as error:
+                errors.append({'row': row, 'error': str(error)})
+                continue
+
+            chunk.append(values)
+            chunk_rows.append(row)
+            if len(chunk) >= chunk_size:
+                imported += flush()
+                chunk, chunk_rows = [], []
+    except RowError as error:
+        # the file cannot be read any further
+        errors.append({'row': None, 'error': str(error)})
+
+    if chunk:
+        imported += flush()
+    return imported, errors
+
+
+EXPORT_COLUMNS = ('id',) + COLUMNS
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def _ndjson(rows, header):
+    return b''.join(dumps(dict(zip(EXPORT_COLUMNS, row))) + b'\n'
+                    for row in rows)
+
+
+def _csv(rows, header):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+WRITERS = {
+    'ndjson': _ndjson,
+    'csv': _csv
+}
+
+
+'''
+export_questions(format_name, category=None, since_id=None)
+    generator of the encoded questions ordered by id, EXPORT_BATCH_SIZE
+    rows at a time. The rows come from a single SELECT on a connection
+    of its own, which stays open for as long as the response streams:
+    on Postgres it is read through a server-side cursor, so memory stays
+    flat, and a single statement sees a single snapshot of the table
+    whatever is written while it is read.
+'''
+
+
+def export_questions(format_name, category=None, since_id=None,
+                     batch_size=None):
+    batch_size = batch_size or EXPORT_BATCH_SIZE
+    write = WRITERS[format_name]
+    table = Question.__table__
+    query = select([table.c[column] for column in EXPORT_COLUMNS])
+    if category is not None:
+        query = query.where(table.c.category == category)
+    if since_id is not None:
+        query = query.where(table.c.id > since_id)
+    query = query.order_by(table.c.id)
+
+    engines = shards.engines(category) if shards.enabled else [db.engine]
+    connections = [engine.connect().execution_options(stream_results=True)
+                   for engine in engines]
+    try:
+        # the rows of each shard come ordered by id, and are merged
+        rows = heapq.merge(*[connection.execute(query)
+                             for connection in connections],
+                           key=lambda row: row[0])
+        header = True
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch and not header:
+                return
+            yield write(batch, header)
+            header = False
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+'''
+Set-based writes
+    bulk_delete and bulk_update change every question matching
+    'criteria' in a single statement and one transaction. criteria()
+    builds the WHERE clause from a list of ids and/or a filter on
+    category and difficulty. Both return (count, ids), the ids of the
+    changed questions come from RETURNING on Postgres and from a SELECT
+    in the same transaction on databases without it.
+'''
+
+# ids looked up with one IN (...) when questions are read back by id
+ID_BATCH_SIZE = 500
+
+
+def criteria(ids=None, category=None, difficulty=None):
+    table = Question.__table__
+    clauses = []
+    if ids is not None:
+        clauses.append(table.c.id.in_(ids))
+    if category is not None:
+        clauses.append(table.c.category == category)
+    if difficulty is not None:
+        clauses.append(table.c.difficulty == difficulty)
+    return and_(*clauses)
+
+
+def _execute(statement, where):
+    returning = db.engine.dialect.name == 'postgresql'
+    if returning:
+        statement = statement.returning(Question.__table__.c.id)
+
+    def execute(connection):
+        if returning:
+            return [row[0] for row in connection.execute(statement)]
+        # the rows the statement is about to change
+        ids = [row[0] for row in connection.execute(
+            select([Question.__table__.c.id]).where(where))]
+        connection.execute(statement)
+        return ids
+
+    if shards.enabled:
+        # on every shard, each in its own transaction
+        results = shards.each(execute)
+    else:
+        results = [execute(db.session)]
+        db.session.commit()
+    ids = sorted(question_id for changed in results
+                 for question_id in changed)
+    return len(ids), ids
+
+
+def bulk_delete(where):
+    return _execute(delete(Question.__table__).where(where), where)
+
+
+def bulk_update(where, values):
+    table = Question.__table__
+    # a new row_version, the cached JSON of the questions is stale
+    return _execute(update(table).where(where).values(
+        row_version=table.c.row_version + 1, **values), where)
+
+
+def last_question_id():
+    # the highest id of the bank, 0 when it is empty
+    rows = fetch(db.session.query(Question.id).order_by(
+        Question.id.desc()).limit(1), limit=1, reverse=True)
+    return rows[0].id if rows else 0
+
+
+def indexed_questions(ids=None, after=None):
+    # the columns the in-process indexes are built from, of the
+    # questions 'ids' or of the questions after the id 'after'
+    query = db.session.query(
+        Question.id, Question.question, Question.answer,
+        Question.category).order_by(Question.id)
+    if after is not None:
+        return fetch(query.filter(Question.id > after))
+    rows = []
+    for start in range(0, len(ids), ID_BATCH_SIZE):
+        rows.extend(fetch(query.filter(
+            Question.id.in_(ids[start:start + ID_BATCH_SIZE]))))
+    return rows
+
+
+'''
+update_question(question_id, values, row_version=None)
+    applies 'values' to one question with a single UPDATE and returns
+    the updated row, or None when no question has this id or, given a
+    'row_version', when the question was changed since that version.
+    The row comes from RETURNING on Postgres and from a primary key
+    lookup in the same transaction elsewhere.
+'''
+
+
+def update_question(question_id, values, row_version=None):
+    table = Question.__table__
+    where = table.c.id == question_id
+    if row_version is not None:
+        # optimistic concurrency, the update only applies to the
+        # version the client has seen
+        where = and_(where, table.c.row_version == row_version)
+    statement = update(table).where(where).values(
+        row_version=table.c.row_version + 1, **values)
+    columns = [table.c[column] for column in EXPORT_COLUMNS] + \
+        [table.c.row_version]
+
+    returning = db.engine.dialect.name == 'postgresql'
+
+    def execute(connection):
+        if returning:
+            return connection.execute(statement.returning(*columns)).first()
+        if connection.execute(statement).rowcount:
+            return connection.execute(
+                select(columns).where(table.c.id == question_id)).first()
+        return None
+
+    if shards.enabled:
+        # the question is on one shard, unknown from its id alone
+        rows = [row for row in shards.each(execute) if row is not None]
+        return rows[0] if rows else None
+    row = execute(db.session)
+    db.session.commit()
+    return row
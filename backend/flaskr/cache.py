@@ -0,0 +1,259 @@
+import datetime
+import functools
+import hashlib
+import threading
+import time
+
+from flask import current_app, request
+from sqlalchemy import update
+
+from models import db, Category, QuestionBank
+from routing import on_primary
+
+# seconds after which a cached entry checks the bank version even if
+# this process has not seen a write, so that several workers converge
+CACHE_TTL = 30
+
+
+'''
+BankVersion
+    version of the question bank, kept in the question_bank table and
+    mirrored in process. Every write endpoint bumps it, caches built from
+    the bank remember the version they were built at and reload as soon
+    as it has moved on. refresh() reads the version another worker may
+    have bumped.
+'''
+
+
+class BankVersion(object):
+
+    def __init__(self):
+        self.value = 0
+        self.updated_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        # one primary key lookup, returns the current version; a replica
+        # behind the primary would move the version back
+        with on_primary(db.session()):
+            bank = db.session.query(
+                QuestionBank.version, QuestionBank.updated_at).filter(
+                QuestionBank.id == 1).first()
+        if bank is not None:
+            with self._lock:
+                self.value, self.updated_at = bank.version, bank.updated_at
+        return self.value
+
+    def read(self):
+        # (version, updated_at) as seen by the bind the request reads
+        # from, a replica when it uses one, so that validators match the
+        # body read next. The mirror only moves forward from a replica.
+        session = db.session()
+        if session.replica is None:
+            return self.refresh(), self.updated_at
+        bank = session.query(
+            QuestionBank.version, QuestionBank.updated_at).filter(
+            QuestionBank.id == 1).first()
+        if bank is None:
+            return self.value, self.updated_at
+        with self._lock:
+            if bank.version > self.value:
+                self.value, self.updated_at = bank.version, bank.updated_at
+        return bank.version, bank.updated_at
+
+    def bump(self):
+        # increments the version after a write has been committed,
+        # returns the new version
+        now = datetime.datetime.utcnow()
+        updated = db.session.execute(update(QuestionBank.__table__).where(
+            QuestionBank.id == 1).values(
+            version=QuestionBank.version + 1, updated_at=now)).rowcount
+        if not updated:
+            # databases which were not migrated yet
+            db.session.add(QuestionBank(
+                id=1, version=self.value + 1, updated_at=now))
+        db.session.commit()
+        return self.refresh()
+
+
+bank_version = BankVersion()
+
+
+'''
+VersionedCache
+    an entry loaded from the database, reloaded once the bank version
+    has moved on. After 'ttl' seconds the version is read again, and the
+    entry is kept if no other worker changed the bank since, so entries
+    built before a pre-fork server forks stay shared by its workers.
+    Subclasses implement _load().
+'''
+
+
+class VersionedCache(object):
+
+    def __init__(self, version=bank_version, ttl=CACHE_TTL):
+        self.version = version
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entry = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # returns the entry as a dict
+        raise NotImplementedError
+
+    def _fresh(self, entry):
+        return entry is not None and \
+            entry['version'] == self.version.value and \
+            time.monotonic() - entry['loaded_at'] < self.ttl
+
+    def _get(self):
+        entry = self._entry
+        if self._fresh(entry):
+            self.hits += 1
+            return entry
+
+        with self._lock:
+            # another thread may have reloaded while we were waiting
+            entry = self._entry
+            if self._fresh(entry):
+                self.hits += 1
+                return entry
+
+            if entry is not None and \
+                    entry['version'] == self.version.value:
+                # expired, one primary key lookup tells whether it
+                # is still current
+                with on_primary(db.session()):
+                    current = self.version.refresh()
+                if entry['version'] == current:
+                    entry['loaded_at'] = time.monotonic()
+                    self.hits += 1
+                    return entry
+
+            self.misses += 1
+            # read the version before loading, a write that lands
+            # during the load leaves the entry stale instead of wrong
+            version = self.version.value
+            with on_primary(db.session()):
+                entry = self._load()
+            entry['version'] = version
+            entry['loaded_at'] = time.monotonic()
+            self._entry = entry
+            return entry
+
+    def _apply(self, version, fn):
+        # applies a write of this process to the entry in place if the
+        # entry is exactly one version behind it, otherwise the entry is
+        # left to be reloaded
+        with self._lock:
+            entry = self._entry
+            if entry is not None and entry['version'] == version - 1:
+                fn(entry)
+                entry['version'] = version
+
+    def invalidate(self):
+        self._entry = None
+
+    def warm(self):
+        # loads the entry ahead of the first request
+        self._get()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'version': self.version.value
+        }
+
+
+'''
+CategoryCache
+    the list of categories and an id -> type map.
+'''
+
+
+class CategoryCache(VersionedCache):
+
+    def _load(self):
+        categories = [category.format() for category in
+                      Category.query.order_by(Category.id).all()]
+        return {
+            'categories': categories,
+            'types': [category['type'] for category in categories],
+            'type_map': {category['id']: category['type']
+                         for category in categories}
+        }
+
+    def categories(self):
+        return self._get()['categories']
+
+    def types(self):
+        return self._get()['types']
+
+    def type_map(self):
+        return self._get()['type_map']
+
+
+category_cache = CategoryCache()
+
+
+'''
+conditional(view)
+    conditional GET for views whose response depends only on the URL and
+    the question bank. The ETag is built from the bank version, read on
+    the bind the body is read from, and the URL, Last-Modified is the
+    time of that version, so a request carrying If-None-Match or
+    If-Modified-Since is answered with 304 right after reading the
+    version, before any question is queried. If-None-Match takes
+    precedence over If-Modified-Since.
+'''
+
+
+def as_utc(value):
+    # the database keeps naive UTC datetimes, Werkzeug parses dates as
+    # naive or aware UTC depending on its version
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+
+def conditional(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version, updated_at = bank_version.read()
+        etag = '{}-{}'.format(version, hashlib.sha1(
+            request.full_path.encode()).hexdigest()[:16])
+
+        if updated_at is not None:
+            updated_at = as_utc(updated_at).replace(microsecond=0)
+            # dates have a one second resolution, a write later in the
+            # same second would not change Last-Modified, so it is only
+            # sent once that second is over
+            if datetime.datetime.now(datetime.timezone.utc) - \
+                    updated_at < datetime.timedelta(seconds=1):
+                updated_at = None
+
+        if 'If-None-Match' in request.headers:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = updated_at is not None and \
+                request.if_modified_since is not None and \
+                as_utc(request.if_modified_since) >= updated_at
+
+        if not_modified:
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        if updated_at is not None:
+            response.last_modified = updated_at
+        # clients keep the response but check it is current every time
+        response.cache_control.no_cache = True
+        return response
+
+    return wrapper
@@ -0,0 +1,176 @@
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+from werkzeug.http import parse_accept_header
+
+# bodies smaller than this are not worth compressing
+COMPRESSION_THRESHOLD = 500
+COMPRESSION_LEVEL = 6
+# compressed bodies kept for responses carrying an ETag
+COMPRESSION_CACHE_SIZE = 256
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+# zlib window bits of each encoding, 'deflate' is the zlib format
+WBITS = {'gzip': 31, 'deflate': 15}
+
+ENCODED_ETAG_RE = re.compile(r'-(gzip|deflate)"')
+
+
+def negotiate(accept_encoding):
+    # preferred encoding accepted by the client, or None
+    accepted = parse_accept_header(accept_encoding)
+    best = max(WBITS, key=lambda encoding: (
+        accepted.quality(encoding), encoding == 'gzip'))
+    return best if accepted.quality(best) > 0 else None
+
+
+'''
+CompressionMiddleware
+    WSGI middleware compressing responses with gzip or deflate as
+    negotiated through Accept-Encoding. Bodies below the threshold are
+    sent as they are, bodies of unknown length are compressed as they
+    are streamed. GET responses with an ETag are compressed once and
+    then served from an LRU cache keyed by ETag and encoding.
+
+    A compressed response gets its own ETag, '"<etag>-gzip"'. The suffix
+    is removed from If-None-Match before the request reaches the app, so
+    conditional requests keep working.
+'''
+
+
+class CompressionMiddleware(object):
+
+    def __init__(self, app, threshold=COMPRESSION_THRESHOLD,
+                 level=COMPRESSION_LEVEL, cache_size=COMPRESSION_CACHE_SIZE):
+        self.app = app
+        self.threshold = threshold
+        self.level = level
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._cache)
+        }
+
+    def _cached(self, key):
+        with self._lock:
+            body = self._cache.get(key)
+            if body is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            return body
+
+    def _store(self, key, body):
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = body
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _compressor(self, encoding):
+        return zlib.compressobj(self.level, zlib.DEFLATED, WBITS[encoding])
+
+    def _compress(self, encoding, chunks):
+        compressor = self._compressor(encoding)
+        return b''.join([compressor.compress(chunk) for chunk in chunks] +
+                        [compressor.flush()])
+
+    def _stream(self, encoding, body):
+        compressor = self._compressor(encoding)
+        try:
+            for chunk in body:
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def __call__(self, environ, start_response):
+        encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return self.app(environ, start_response)
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            environ['HTTP_IF_NONE_MATCH'] = ENCODED_ETAG_RE.sub(
+                '"', if_none_match)
+
+        captured = {}
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+            return written.append
+
+        body = self.app(environ, capture)
+        status, headers = captured['status'], captured['headers']
+        if written:
+            body = written + list(body)
+
+        header = {name.lower(): value for name, value in headers}
+        etag = header.get('etag')
+
+        if status.startswith('304') and etag and if_none_match and \
+                ENCODED_ETAG_RE.search(if_none_match):
+            # the client holds the compressed representation
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'etag']
+            headers.append(('ETag', '{}-{}"'.format(etag[:-1], encoding)))
+            headers.append(('Vary', 'Accept-Encoding'))
+            start_response(status, headers, captured['exc_info'])
+            return body
+
+        length = header.get('content-length')
+        if not status.startswith('200') or \
+                'content-encoding' in header or \
+                not header.get('content-type', '').startswith(
+                    COMPRESSIBLE_TYPES) or \
+                length is not None and int(length) < self.threshold:
+            start_response(status, headers, captured['exc_info'])
+            return body
+
+        if environ['REQUEST_METHOD'] == 'GET' and etag:
+            key = (etag, encoding)
+            compressed = self._cached(key)
+            if compressed is None:
+                compressed = self._compress(encoding, body)
+                self._store(key, compressed)
+            if hasattr(body, 'close'):
+                body.close()
+        elif length is not None:
+            compressed = self._compress(encoding, body)
+            if hasattr(body, 'close'):
+                body.close()
+        else:
+            # streamed body, compressed chunk by chunk
+            start_response(status, self._encoded_headers(
+                headers, encoding, etag), captured['exc_info'])
+            return self._stream(encoding, body)
+
+        headers = self._encoded_headers(headers, encoding, etag)
+        headers.append(('Content-Length', str(len(compressed))))
+        start_response(status, headers, captured['exc_info'])
+        return [compressed]
+
+    @staticmethod
+    def _encoded_headers(headers, encoding, etag):
+        headers = [(name, value) for name, value in headers
+                   if name.lower() not in ('content-length', 'etag')]
+        headers.append(('Content-Encoding', encoding))
+        headers.append(('Vary', 'Accept-Encoding'))
+        if etag:
+            headers.append(('ETag', '{}-{}"'.format(etag[:-1], encoding)))
+        return headers
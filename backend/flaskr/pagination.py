@@ -0,0 +1,125 @@
+import base64
+import binascii
+import json
+
+from flask import abort
+
+from models import Question
+from .sharding import count, fetch, shards
+
+QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+# deepest row a page of a sharded bank may reach, every shard returns
+# the rows up to it; deeper pages are read with a cursor
+MAX_SHARDED_OFFSET = 10000
+
+
+def get_per_page(request):
+    # number of questions per page, capped so a client cannot
+    # ask for the whole table in one page
+    per_page = request.args.get('per_page', QUESTIONS_PER_PAGE, type=int)
+    return max(1, min(per_page, MAX_QUESTIONS_PER_PAGE))
+
+
+def paginate_questions(request, selection, category=None):
+    # 'selection' is a query, LIMIT/OFFSET and COUNT are run in the
+    # database so only the rows of the requested page are loaded.
+    # 'category' narrows a sharded bank to one shard.
+    # returns (questions of the page, number of questions)
+    page = request.args.get('page', 1, type=int)
+    per_page = get_per_page(request)
+
+    if shards.enabled:
+        # each shard returns its first rows up to the end of the page,
+        # merged by id
+        end = max(page, 1) * per_page
+        if end > MAX_SHARDED_OFFSET:
+            abort(400, description=(
+                'page reaches past the first {} questions of a sharded '
+                'bank, pass cursor instead').format(MAX_SHARDED_OFFSET))
+        rows = fetch(selection.limit(end), category, limit=end)
+        return rows[end - per_page:], count(selection, category)
+
+    current_page = selection.paginate(page, per_page, error_out=False)
+
+    return current_page.items, current_page.total
+
+
+'''
+Cursor (keyset) pagination
+
+A cursor is an opaque token holding the direction and the key of the
+last row a client has seen, (id) for the whole bank and (category, id)
+inside a category. The next page is found by seeking past that key on
+an index instead of skipping N rows, so the cost does not grow with
+the page number and pages do not shift when rows are inserted or
+deleted in between two requests.
+'''
+
+
+def encode_cursor(direction, question_id, category=None):
+    key = [question_id] if category is None else [category, question_id]
+    token = json.dumps({'d': direction, 'k': key}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, category=None):
+    # returns (direction, question_id), aborts with 400 on tokens
+    # which are malformed or were issued for another listing
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        cursor = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        direction = cursor['d']
+        key = cursor['k']
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        abort(400)
+
+    expected = [category] if category is not None else []
+    if direction not in ('next', 'prev') or \
+            not isinstance(key, list) or \
+            len(key) != len(expected) + 1 or \
+            key[:-1] != expected or \
+            not isinstance(key[-1], int):
+        abort(400)
+
+    return direction, key[-1]
+
+
+def seek_questions(request, selection, category=None):
+    # 'selection' is the filtered question query, its ordering is
+    # replaced by the id ordering of the seek.
+    # returns (questions of the page, next and previous cursors)
+    token = request.args.get('cursor', '')
+    per_page = get_per_page(request)
+    selection = selection.order_by(None)
+
+    if token:
+        direction, last_id = decode_cursor(token, category)
+    else:
+        direction, last_id = 'next', None
+
+    if direction == 'next':
+        if last_id is not None:
+            selection = selection.filter(Question.id > last_id)
+        rows = fetch(selection.order_by(Question.id).limit(per_page + 1),
+                     category, limit=per_page + 1)
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        has_next, has_prev = has_more, last_id is not None
+    else:
+        rows = fetch(selection.filter(Question.id < last_id).order_by(
+            Question.id.desc()).limit(per_page + 1),
+            category, limit=per_page + 1, reverse=True)
+        has_more = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_next, has_prev = True, has_more
+
+    cursors = {'next_cursor': None, 'prev_cursor': None}
+    if rows and has_next:
+        cursors['next_cursor'] = encode_cursor(
+            'next', rows[-1].id, category)
+    if rows and has_prev:
+        cursors['prev_cursor'] = encode_cursor(
+            'prev', rows[0].id, category)
+
+    return rows, cursors
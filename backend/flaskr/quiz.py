@@ -0,0 +1,278 @@
+import bisect
+import hashlib
+import random
+from array import array
+
+from models import db, Question
+from .cache import VersionedCache
+from .sharding import fetch, get_question, shards
+
+# random draws tried against the pool before falling back to SQL,
+# only reached once most of a category has already been played
+MAX_DRAW_ATTEMPTS = 8
+# most questions returned by one call to POST /quizzes
+MAX_QUIZ_BATCH = 50
+
+
+'''
+QuestionPool
+    the ids of all questions, grouped per category in compact int
+    arrays. A random unseen id is drawn by rejection sampling, which
+    takes constant expected time while a quiz has seen only part of the
+    category. Writes of this process are applied by update(), the pool
+    is rebuilt when the bank version was moved on by anything else,
+    which is checked at least every CACHE_TTL seconds.
+'''
+
+# changes above which update() rebuilds an array rather than inserting
+# and deleting ids one by one
+MAX_ARRAY_EDITS = 64
+
+
+def group_ids(rows):
+    # the pool entry for (id, category) rows ordered by id
+    all_ids = array('l')
+    by_category = {}
+    for question_id, category in rows:
+        all_ids.append(question_id)
+        if category is not None:
+            by_category.setdefault(
+                int(category), array('l')).append(question_id)
+
+    return {
+        'all': all_ids,
+        'by_category': by_category
+    }
+
+
+def has_id(ids, question_id):
+    # whether the sorted 'ids' hold 'question_id'
+    index = bisect.bisect_left(ids, question_id)
+    return index < len(ids) and ids[index] == question_id
+
+
+def merge_ids(ids, removed, added):
+    # a sorted copy of 'ids' without the ids 'removed', with 'added'
+    if len(removed) + len(added) > MAX_ARRAY_EDITS:
+        return array('l', sorted([question_id for question_id in ids
+                                  if question_id not in removed] + added))
+    merged = array('l', ids)
+    for question_id in removed:
+        index = bisect.bisect_left(merged, question_id)
+        if index < len(merged) and merged[index] == question_id:
+            del merged[index]
+    for question_id in added:
+        bisect.insort(merged, question_id)
+    return merged
+
+
+def draw_id(ids, seen):
+    # returns a random id of 'ids' not in 'seen', or None when no such
+    # id was hit within MAX_DRAW_ATTEMPTS tries
+    if len(ids) <= len(seen):
+        # possibly exhausted, let the caller decide exactly
+        return None
+
+    for _ in range(MAX_DRAW_ATTEMPTS):
+        question_id = ids[random.randrange(len(ids))]
+        if question_id not in seen:
+            return question_id
+    return None
+
+
+class QuestionPool(VersionedCache):
+
+    def _load(self):
+        query = db.session.query(Question.id, Question.category).order_by(
+            Question.id)
+        rows = fetch(query) if shards.enabled else query.yield_per(10000)
+        return group_ids(rows)
+
+    def update(self, version, removed=(), questions=()):
+        # applies a write of this process: the ids 'removed' are taken
+        # out, then 'questions' are added to their category. The arrays
+        # are replaced by changed copies, draws of other threads index
+        # them meanwhile
+        removed = set(removed).union(question.id for question in questions)
+        added = {}
+        for question in questions:
+            if question.category is not None:
+                added.setdefault(int(question.category), []).append(
+                    question.id)
+
+        def apply(entry):
+            by_category = dict(entry['by_category'])
+            changed = set(added)
+            for category, ids in by_category.items():
+                if any(has_id(ids, question_id) for question_id in removed):
+                    changed.add(category)
+            for category in changed:
+                ids = merge_ids(by_category.get(category, ()), removed,
+                                added.get(category, []))
+                if ids:
+                    by_category[category] = ids
+                else:
+                    del by_category[category]
+            entry['all'] = merge_ids(entry['all'], removed, [
+                question.id for question in questions])
+            entry['by_category'] = by_category
+
+        self._apply(version, apply)
+
+    def ids(self, category=None):
+        # ids of a category, or of the whole bank if category is None
+        entry = self._get()
+        if category is None:
+            return entry['all']
+        return entry['by_category'].get(category, array('l'))
+
+    def draw(self, category, seen):
+        return draw_id(self.ids(category), seen)
+
+
+question_pool = QuestionPool()
+
+
+def random_question_sql(category, seen):
+    # fallback: count the unseen questions on the index and pick one
+    # at a random offset, only the chosen row is loaded
+    selection = Question.query
+    if category is not None:
+        selection = selection.filter(Question.category == category)
+    if seen:
+        selection = selection.filter(Question.id.notin_(seen))
+    if shards.enabled:
+        return shards.random(selection, category)
+
+    total = selection.count()
+    if not total:
+        return None
+
+    return selection.order_by(Question.id).offset(
+        random.randrange(total)).limit(1).first()
+
+
+def select_questions(category, previous_questions, count=1):
+    # up to 'count' distinct random questions of 'category' (None for
+    # all categories) which are not in 'previous_questions', sampled
+    # without replacement from the pool and loaded in one query
+    seen = set(previous_questions)
+    drawn = []
+    while len(drawn) < count:
+        question_id = question_pool.draw(category, seen)
+        if question_id is None:
+            break
+        seen.add(question_id)
+        drawn.append(question_id)
+
+    questions = []
+    if drawn:
+        rows = {question.id: question for question in
+                fetch(Question.query.filter(Question.id.in_(drawn)).order_by(
+                    Question.id), category)}
+        for question_id in drawn:
+            question = rows.get(question_id)
+            # the pool may lag behind writes made by another process
+            if question is not None and (
+                    category is None or question.category is not None and
+                    int(question.category) == category):
+                questions.append(question)
+
+    while len(questions) < count:
+        question = random_question_sql(category, seen)
+        if question is None:
+            break
+        seen.add(question.id)
+        questions.append(question)
+
+    return questions
+
+
+'''
+Seeded decks
+    a quiz identified by a seed plays the questions of its category in
+    an order derived from the seed alone: the question at 'position' is
+    the permuted index into the ids of the category in the quiz pool.
+    The 'domain' of a deck, the number of questions of the category and
+    its last id when the quiz started, keeps the order: questions added
+    during the quiz come after the last id and are not asked. A question
+    deleted during the quiz shifts the ones with higher ids down by one
+    index, and the indexes past the questions left are skipped. Every
+    worker computes the same order without storing anything, and
+    without materializing the deck, as the permutation is a keyed
+    Feistel network with cycle walking that maps one position in
+    constant expected time.
+'''
+
+FEISTEL_ROUNDS = 4
+
+
+def deck_key(seed, category):
+    return hashlib.sha256(
+        '{}:{}'.format(seed, category).encode()).digest()
+
+
+def _feistel_round(key, round_number, value, bits):
+    digest = hashlib.blake2b(
+        '{}:{}'.format(round_number, value).encode(),
+        key=key, digest_size=8).digest()
+    return int.from_bytes(digest, 'big') & ((1 << bits) - 1)
+
+
+def permute(index, size, key):
+    # maps index in [0, size) to a distinct index in [0, size)
+    half = max(1, ((size - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    value = index
+    while True:
+        left, right = value >> half, value & mask
+        for round_number in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ _feistel_round(
+                key, round_number, right, half)
+        value = (left << half) | right
+        # the network permutes a power of four, walk the cycle until
+        # it comes back into range
+        if value < size:
+            return value
+
+
+def seeded_domain(category):
+    # [number of questions, last id] of the category
+    ids = question_pool.ids(category)
+    return [len(ids), ids[-1] if ids else 0]
+
+
+def seeded_questions(category, seed, position, domain, count=1):
+    # the next 'count' questions of a seeded deck, returns
+    # (questions, next position)
+    questions = []
+    while len(questions) < count:
+        question, position = seeded_question(
+            category, seed, position, domain)
+        if question is None:
+            break
+        questions.append(question)
+    return questions, position
+
+
+def seeded_question(category, seed, position, domain):
+    # returns (question, next position), question is None once the
+    # deck is played out
+    ids = question_pool.ids(category)
+    key = deck_key(seed, category)
+    size, last = domain
+    # the questions of the deck still in the category
+    left = bisect.bisect_right(ids, last)
+
+    while 0 <= position < size:
+        index = permute(position, size, key)
+        position += 1
+        if index >= left:
+            # deleted during the quiz
+            continue
+        # the pool may lag behind deletes made by another process
+        question = get_question(ids[index])
+        if question is not None:
+            return question, position
+
+    return None, position
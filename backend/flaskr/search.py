@@ -0,0 +1,362 @@
+import heapq
+import math
+import re
+import unicodedata
+from array import array
+from collections import Counter
+
+from flask import current_app
+from sqlalchemy import func, text
+
+from models import db, Question
+from .cache import VersionedCache
+from .sharding import fetch, shards
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'did', 'do', 'does',
+    'for', 'from', 'has', 'have', 'in', 'is', 'it', 'its', 'of', 'on',
+    'or', 'the', 'this', 'to', 'was', 'were', 'what', 'which', 'who',
+    'with'))
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def normalize(value):
+    # lower case and strip accents, 'Café' -> 'cafe'
+    decomposed = unicodedata.normalize('NFKD', value or '')
+    return ''.join(
+        char for char in decomposed
+        if not unicodedata.combining(char)).lower()
+
+
+def tokenize(value):
+    return [token for token in TOKEN_RE.findall(normalize(value))
+            if token not in STOPWORDS]
+
+
+'''
+SearchIndex
+    in-process inverted index over question and answer text. Each term
+    maps to a postings dict of question id -> term frequency, queries
+    are ranked with BM25. The index is built on first use, kept up to
+    date by update() for writes of this process, and rebuilt when the
+    bank version was moved on by anything else, which is checked at
+    least every CACHE_TTL seconds.
+'''
+
+
+class SearchIndex(VersionedCache):
+
+    @staticmethod
+    def _add(entry, question_id, *texts, copy=False):
+        # with 'copy' the postings of the terms are replaced by changed
+        # copies, searches of other threads iterate them meanwhile
+        terms = tokenize(' '.join(value or '' for value in texts))
+        frequencies = {}
+        for term in terms:
+            frequencies[term] = frequencies.get(term, 0) + 1
+        entry['terms'][question_id] = tuple(frequencies)
+        entry['lengths'][question_id] = len(terms)
+        entry['total_length'] += len(terms)
+        for term, frequency in frequencies.items():
+            postings = entry['postings'].get(term, {})
+            if copy:
+                postings = dict(postings)
+            postings[question_id] = frequency
+            entry['postings'][term] = postings
+
+    @staticmethod
+    def _remove(entry, question_id):
+        # only applied to an entry in use, see _add()
+        for term in entry['terms'].pop(question_id, ()):
+            postings = dict(entry['postings'][term])
+            del postings[question_id]
+            if postings:
+                entry['postings'][term] = postings
+            else:
+                del entry['postings'][term]
+        entry['total_length'] -= entry['lengths'].pop(question_id, 0)
+
+    def _load(self):
+        entry = {
+            'postings': {},
+            'terms': {},
+            'lengths': {},
+            'total_length': 0
+        }
+        query = db.session.query(
+            Question.id, Question.question, Question.answer).order_by(
+            Question.id)
+        rows = fetch(query) if shards.enabled else query.yield_per(10000)
+        for question_id, question, answer in rows:
+            self._add(entry, question_id, question, answer)
+        return entry
+
+    def update(self, version, removed=(), questions=()):
+        # applies a write of this process: the ids 'removed' are taken
+        # out, then 'questions' are indexed again with their new text
+        def apply(entry):
+            for question_id in set(removed).union(
+                    question.id for question in questions):
+                self._remove(entry, question_id)
+            for question in questions:
+                self._add(entry, question.id, question.question,
+                          question.answer, copy=True)
+        self._apply(version, apply)
+
+    def add(self, question, version):
+        self.update(version, questions=[question])
+
+    def remove(self, question_id, version):
+        self.update(version, removed=[question_id])
+
+    def search(self, query, offset, limit):
+        # returns (ids of the requested page by rank, number of matches)
+        entry = self._get()
+        lengths = entry['lengths']
+        documents = len(lengths)
+        if not documents:
+            return [], 0
+        average_length = entry['total_length'] / documents
+
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = entry['postings'].get(term)
+            if not postings:
+                continue
+            idf = math.log(
+                1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+            for question_id, frequency in postings.items():
+                length = lengths.get(question_id)
+                if length is None:
+                    # removed since the postings were read
+                    continue
+                norm = K1 * (1 - B + B * length / average_length)
+                scores[question_id] = scores.get(question_id, 0) + \
+                    idf * frequency * (K1 + 1) / (frequency + norm)
+
+        # best score first, lower id first between equal scores
+        ranked = heapq.nsmallest(
+            offset + limit, scores, key=lambda key: (-scores[key], key))
+        return ranked[offset:], len(scores)
+
+
+search_index = SearchIndex()
+
+
+'''
+TrigramIndex
+    maps each three character sequence of the normalized question text
+    to the ids of the questions containing it. A substring of three or
+    more characters can only occur in questions holding all of its
+    trigrams, so the postings are intersected and only those questions
+    are checked. Fuzzy matching scores a question by the share of the
+    search term's trigrams it contains, which tolerates typos.
+'''
+
+# share of the search term's trigrams a question needs for a fuzzy match
+FUZZY_THRESHOLD = 0.3
+
+
+def squash(value):
+    # normalized text with single spaces and a space at both ends, so
+    # that words are delimited like they are in the middle of the text
+    return ' {} '.format(' '.join(normalize(value).split()))
+
+
+def trigrams(value):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class TrigramIndex(VersionedCache):
+
+    @staticmethod
+    def _add(entry, question_id, question):
+        value = squash(question)
+        entry['texts'][question_id] = value
+        for trigram in trigrams(value):
+            entry['postings'].setdefault(trigram, array('l')).append(
+                question_id)
+
+    @staticmethod
+    def _remove(entry, question_id):
+        # the postings of its trigrams are replaced by copies without
+        # the id, lookups of other threads iterate them meanwhile
+        value = entry['texts'].pop(question_id, None)
+        if value is None:
+            return
+        for trigram in trigrams(value):
+            postings = entry['postings'].get(trigram, array('l'))
+            try:
+                index = postings.index(question_id)
+            except ValueError:
+                continue
+            entry['postings'][trigram] = \
+                postings[:index] + postings[index + 1:]
+
+    def _load(self):
+        entry = {'postings': {}, 'texts': {}}
+        query = db.session.query(Question.id, Question.question).order_by(
+            Question.id)
+        rows = fetch(query) if shards.enabled else query.yield_per(10000)
+        for question_id, question in rows:
+            self._add(entry, question_id, question)
+        return entry
+
+    def update(self, version, removed=(), questions=()):
+        # see SearchIndex.update()
+        def apply(entry):
+            for question_id in set(removed).union(
+                    question.id for question in questions):
+                self._remove(entry, question_id)
+            for question in questions:
+                self._add(entry, question.id, question.question)
+        self._apply(version, apply)
+
+    def add(self, question, version):
+        self.update(version, questions=[question])
+
+    def remove(self, question_id, version):
+        self.update(version, removed=[question_id])
+
+    def substring(self, term):
+        # ids of the questions containing 'term', like ILIKE '%term%'
+        entry = self._get()
+        texts = entry['texts']
+        term = ' '.join(normalize(term).split())
+        if not term.strip():
+            return []
+
+        candidates = None
+        grams = sorted(trigrams(term), key=lambda gram: len(
+            entry['postings'].get(gram, ())))
+        for gram in grams:
+            postings = entry['postings'].get(gram, ())
+            candidates = set(postings) if candidates is None else \
+                candidates.intersection(postings)
+            if not candidates:
+                return []
+
+        if candidates is None:
+            # shorter than a trigram, check every question; writes of
+            # other threads change 'texts' in place
+            with self._lock:
+                candidates = list(texts)
+
+        return sorted(question_id for question_id in candidates
+                      if term in texts.get(question_id, ''))
+
+    def fuzzy(self, term, threshold=FUZZY_THRESHOLD):
+        # [(question id, similarity)] best match first. Questions which
+        # contain 'term' come first with a similarity of 1, followed by
+        # the ones holding at least 'threshold' of its trigrams
+        entry = self._get()
+        texts = entry['texts']
+        exact = self.substring(term)
+        grams = trigrams(squash(term))
+
+        shared = Counter()
+        for gram in grams:
+            shared.update(entry['postings'].get(gram, ()))
+
+        exact_ids = set(exact)
+        similar = [(question_id, count / len(grams))
+                   for question_id, count in shared.items()
+                   if question_id in texts and question_id not in exact_ids
+                   and count / len(grams) >= threshold]
+        similar.sort(key=lambda match: (-match[1], match[0]))
+        return [(question_id, 1.0) for question_id in exact] + similar
+
+
+trigram_index = TrigramIndex()
+
+
+def fuzzy_search_questions(query, page, per_page, threshold=FUZZY_THRESHOLD,
+                           selection=None):
+    # returns (questions of the requested page by similarity, number
+    # of matches), loaded with 'selection' when given
+    offset = (max(page, 1) - 1) * per_page
+    matches = trigram_index.fuzzy(query, threshold)
+    ids = [question_id for question_id, _ in
+           matches[offset:offset + per_page]]
+    if not ids:
+        return [], len(matches)
+
+    if selection is None:
+        selection = Question.query
+    rows = {question.id: question for question in fetch(
+            selection.filter(Question.id.in_(ids)).order_by(Question.id))}
+    return [rows[question_id] for question_id in ids
+            if question_id in rows], len(matches)
+
+
+'''
+Database search
+    delegates ranking to the database: a tsvector query on Postgres
+    and an FTS5 table kept in sync by triggers on SQLite, both indexed
+    by migration 4.
+'''
+
+
+def _postgres_search(terms, offset, limit):
+    document = func.to_tsvector(
+        'english',
+        func.coalesce(Question.question, '') + ' ' +
+        func.coalesce(Question.answer, ''))
+    query = func.to_tsquery('english', ' | '.join(terms))
+    matches = db.session.query(Question.id).filter(
+        document.op('@@')(query))
+
+    total = matches.count()
+    ids = [question_id for (question_id,) in matches.order_by(
+        func.ts_rank(document, query).desc(), Question.id).offset(
+        offset).limit(limit)]
+    return ids, total
+
+
+def _sqlite_search(terms, offset, limit):
+    # questions_fts is created by 'flask db upgrade'
+    match = ' OR '.join('"{}"'.format(term) for term in terms)
+    total = db.session.execute(text(
+        'SELECT COUNT(*) FROM questions_fts WHERE questions_fts MATCH :match'),
+        {'match': match}).scalar()
+    ids = [row[0] for row in db.session.execute(text(
+        'SELECT rowid FROM questions_fts WHERE questions_fts MATCH :match '
+        'ORDER BY bm25(questions_fts), rowid LIMIT :limit OFFSET :offset'),
+        {'match': match, 'limit': limit, 'offset': offset})]
+    return ids, total
+
+
+def search_questions(query, page, per_page, selection=None):
+    # returns (questions of the requested page by rank, number of
+    # matches) from the backend set by SEARCH_BACKEND, loaded with
+    # 'selection' when given
+    offset = (max(page, 1) - 1) * per_page
+
+    # the database backends index a single database, sharded banks
+    # are searched in memory
+    if current_app.config.get('SEARCH_BACKEND') == 'database' and \
+            not shards.enabled:
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return [], 0
+        if db.engine.dialect.name == 'postgresql':
+            ids, total = _postgres_search(terms, offset, per_page)
+        else:
+            ids, total = _sqlite_search(terms, offset, per_page)
+    else:
+        ids, total = search_index.search(query, offset, per_page)
+
+    if not ids:
+        return [], total
+
+    if selection is None:
+        selection = Question.query
+    rows = {question.id: question for question in fetch(
+            selection.filter(Question.id.in_(ids)).order_by(Question.id))}
+    return [rows[question_id] for question_id in ids
+            if question_id in rows], total
@@ -0,0 +1,147 @@
+import json
+import threading
+from collections import OrderedDict
+
+from flask import abort, current_app
+
+from models import Question
+
+try:
+    # faster encoder, used when installed
+    import orjson
+except ImportError:
+    orjson = None
+
+# encoded questions kept in memory
+FRAGMENT_CACHE_SIZE = 100000
+
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+
+def dumps(value):
+    # compact JSON as bytes
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(
+        value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+'''
+FragmentCache
+    the encoded JSON of each question, keyed by (id, row_version,
+    fields) so an updated question is encoded again and a cached
+    fragment is never stale. A page of questions is assembled by joining
+    the fragments of its rows, without calling format() or encoding them
+    again. 'fields' is None for all the fields of format(). The 'size'
+    most recently used fragments are kept.
+'''
+
+
+class FragmentCache(object):
+
+    def __init__(self, size=FRAGMENT_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def fragment(self, question, fields=None):
+        key = (question.id, question.row_version, fields)
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+
+        self.misses += 1
+        if fields is None:
+            fragment = dumps(question.format())
+        else:
+            fragment = dumps({field: getattr(question, field)
+                              for field in fields})
+        with self._lock:
+            self._fragments[key] = fragment
+            while len(self._fragments) > self.size:
+                self._fragments.popitem(last=False)
+        return fragment
+
+    def render(self, questions, fields=None):
+        # the encoded JSON array of 'questions'
+        return b'[' + b','.join(
+            self.fragment(question, fields) for question in questions) + \
+            b']'
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._fragments)
+        }
+
+
+fragment_cache = FragmentCache()
+
+
+def render_questions(questions, fields=None):
+    return fragment_cache.render(questions, fields)
+
+
+'''
+get_fields(request)
+    the question fields asked for by 'fields' (comma separated) and
+    'include_answers', always with the id. None when all of them are
+    sent, which is the default.
+'''
+
+
+def get_fields(request):
+    names = request.args.get('fields')
+    if names is None:
+        fields = set(QUESTION_FIELDS)
+    else:
+        fields = set(name.strip() for name in names.split(',') if name)
+        if fields - set(QUESTION_FIELDS):
+            abort(400)
+
+    include_answers = request.args.get('include_answers', 'true').lower()
+    if include_answers not in ('true', 'false'):
+        abort(400)
+    if include_answers == 'false':
+        fields.discard('answer')
+
+    fields.add('id')
+    if fields == set(QUESTION_FIELDS):
+        return None
+    return tuple(field for field in QUESTION_FIELDS if field in fields)
+
+
+def select_fields(selection, fields):
+    # projects a question query on 'fields' in SQL, the rows keep the
+    # row_version their cached JSON is keyed by
+    if fields is None:
+        return selection
+    columns = [getattr(Question, field) for field in fields]
+    return selection.with_entities(*columns, Question.row_version)
+
+
+def json_body(payload, **fragments):
+    # dumps(payload), with the already encoded JSON 'fragments' added as
+    # the values of their keyword
+    body = dumps(payload)
+    members = [dumps(key) + b':' + fragment
+               for key, fragment in fragments.items()]
+    if len(body) > 2:
+        members.append(body[1:-1])
+    return b'{' + b','.join(members) + b'}\n'
+
+
+def json_response(payload, **fragments):
+    # like jsonify(payload), see json_body()
+    return current_app.response_class(
+        json_body(payload, **fragments), mimetype='application/json')
@@ -0,0 +1,322 @@
+import bisect
+import random
+import secrets
+import threading
+import time
+from array import array
+
+from .cache import bank_version
+from .quiz import question_pool
+
+# seconds a quiz session lives after its last question was drawn
+SESSION_TTL = 30 * 60
+# seconds between two runs of the background sweeper
+SWEEP_INTERVAL = 60
+
+
+def shuffled_deck(ids):
+    # Fisher-Yates shuffle into a compact int array
+    deck = array('l', ids)
+    for i in range(len(deck) - 1, 0, -1):
+        j = random.randint(0, i)
+        deck[i], deck[j] = deck[j], deck[i]
+    return deck
+
+
+'''
+QuizSession
+    a quiz in progress. 'deck' holds the shuffled ids of the quiz and is
+    dealt once, 'position' counts the ids already played, so drawing the
+    next question only moves the position. 'max_id' is the largest id
+    the deck was dealt with: the pool is ordered by id, questions added
+    to the category during the quiz are the ones after it and are
+    shuffled into the ids still to be played.
+'''
+
+# bytes of an id in a stored deck
+ITEM_SIZE = array('l').itemsize
+
+
+class QuizSession(object):
+    __slots__ = ('id', 'category', 'version', 'deck', 'position', 'max_id',
+                 'expires_at')
+
+    def __init__(self, id, category, version, deck, position=0,
+                 max_id=None, expires_at=0):
+        self.id = id
+        self.category = category
+        self.version = version
+        self.deck = deck
+        self.position = position
+        self.max_id = max(deck, default=0) if max_id is None else max_id
+        self.expires_at = expires_at
+
+    def remaining(self):
+        return len(self.deck) - self.position
+
+    def added(self, ids):
+        # the ids of the pool, which is ordered by id, dealt after the deck
+        return ids[bisect.bisect_right(ids, self.max_id):]
+
+    def refresh(self, added, version):
+        # shuffle questions added since the deck was dealt into the
+        # ids still to be played; 'added' may be a little older than
+        # the session, ids it already holds are left out
+        for question_id in added:
+            if question_id <= self.max_id:
+                continue
+            self.deck.append(question_id)
+            j = random.randint(self.position, len(self.deck) - 1)
+            self.deck[-1], self.deck[j] = self.deck[j], self.deck[-1]
+            self.max_id = question_id
+        self.version = version
+
+    def pop(self):
+        # next question id, or None once the deck is played out
+        if self.position >= len(self.deck):
+            return None
+        question_id = self.deck[self.position]
+        self.position += 1
+        return question_id
+
+
+'''
+Session stores
+    a store keeps sessions by id and expires them SESSION_TTL seconds
+    after their last use. MemorySessionStore serves a single process,
+    SQLiteSessionStore shares sessions between the workers of a host
+    through one SQLite file.
+'''
+
+
+class BaseSessionStore(object):
+
+    def __init__(self, ttl=SESSION_TTL, sweep_interval=SWEEP_INTERVAL):
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._sweeper = None
+        self._sweeper_lock = threading.Lock()
+
+    def create(self, category, deck):
+        session = QuizSession(
+            secrets.token_urlsafe(16), category, bank_version.value, deck,
+            expires_at=time.time() + self.ttl)
+        self.save(session)
+        self.start_sweeper()
+        return session
+
+    def draw(self, session_id):
+        # pops the next question id of a session, returns
+        # (remaining, question_id) or (None, None) if there is no
+        # such session
+        version = bank_version.value
+        session = self.peek(session_id)
+        if session is None:
+            return None, None
+        added = None
+        if session.version != version:
+            # the pool may have to be reloaded, which is done before
+            # taking the lock of the store
+            added = session.added(question_pool.ids(session.category))
+        return self.pop(session_id, added, version)
+
+    def start_sweeper(self):
+        # one daemon thread per store, started with the first session
+        with self._sweeper_lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(
+                target=self._sweep_forever, name='quiz-session-sweeper')
+            self._sweeper.daemon = True
+            self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            self.sweep()
+
+    def close(self):
+        # releases what a forked worker must not inherit
+        pass
+
+    def save(self, session):
+        raise NotImplementedError
+
+    def peek(self, session_id):
+        # the session without its deck, or None
+        raise NotImplementedError
+
+    def pop(self, session_id, added, version):
+        # shuffles 'added' into the deck unless the session is at
+        # 'version' already, then pops the next id like draw()
+        raise NotImplementedError
+
+    def sweep(self):
+        raise NotImplementedError
+
+
+class MemorySessionStore(BaseSessionStore):
+
+    def __init__(self, *args, **kwargs):
+        super(MemorySessionStore, self).__init__(*args, **kwargs)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def save(self, session):
+        with self._lock:
+            self._sessions[session.id] = session
+
+    def peek(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is None or session.expires_at < time.time():
+            return None
+        return session
+
+    def pop(self, session_id, added, version):
+        with self._lock:
+            session = self.peek(session_id)
+            if session is None:
+                return None, None
+            if added is not None and session.version != version:
+                session.refresh(added, version)
+            session.expires_at = time.time() + self.ttl
+            question_id = session.pop()
+            return session.remaining(), question_id
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [session_id for session_id, session in
+                       self._sessions.items() if session.expires_at < now]
+            for session_id in expired:
+                del self._sessions[session_id]
+        return len(expired)
+
+
+class SQLiteSessionStore(BaseSessionStore):
+
+    def __init__(self, path, *args, **kwargs):
+        super(SQLiteSessionStore, self).__init__(*args, **kwargs)
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        # one connection per thread, sqlite3 connections can not be
+        # shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # the file is opened by the first quiz, not on start
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS quiz_sessions ('
+                    'id TEXT PRIMARY KEY, category INTEGER, '
+                    'version INTEGER, deck BLOB, position INTEGER, '
+                    'max_id INTEGER, expires_at REAL)')
+                conn.execute(
+                    'CREATE INDEX IF NOT EXISTS ix_quiz_sessions_expires_at '
+                    'ON quiz_sessions (expires_at)')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        # the connection of this thread, others close with their thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self._local = threading.local()
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM quiz_sessions').fetchone()[0]
+
+    def save(self, session):
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO quiz_sessions '
+                '(id, category, version, deck, position, max_id, '
+                'expires_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (session.id, session.category, session.version,
+                 session.deck.tobytes(), session.position, session.max_id,
+                 session.expires_at))
+
+    def peek(self, session_id):
+        row = self._connect().execute(
+            'SELECT category, version, max_id FROM quiz_sessions '
+            'WHERE id = ? AND expires_at >= ?',
+            (session_id, time.time())).fetchone()
+        if row is None:
+            return None
+        return QuizSession(session_id, row[0], row[1], None, max_id=row[2])
+
+    def pop(self, session_id, added, version):
+        # the deck is read and written only when questions were added
+        # to the category, otherwise one id of it is read
+        conn = self._connect()
+        # take the write lock first so that two workers can not pop
+        # the same question of one session
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT version, position, max_id, length(deck) '
+                'FROM quiz_sessions WHERE id = ? AND expires_at >= ?',
+                (session_id, time.time())).fetchone()
+            if row is None:
+                conn.rollback()
+                return None, None
+
+            session_version, position, max_id, size = row
+            size //= ITEM_SIZE
+            if added is not None and session_version != version:
+                session_version = version
+                if added and added[-1] > max_id:
+                    deck = array('l')
+                    deck.frombytes(conn.execute(
+                        'SELECT deck FROM quiz_sessions WHERE id = ?',
+                        (session_id,)).fetchone()[0])
+                    session = QuizSession(session_id, None, version, deck,
+                                          position, max_id)
+                    session.refresh(added, version)
+                    conn.execute(
+                        'UPDATE quiz_sessions SET deck = ?, max_id = ? '
+                        'WHERE id = ?',
+                        (deck.tobytes(), session.max_id, session_id))
+                    size = len(deck)
+
+            question_id = None
+            if position < size:
+                question_id = array('l', conn.execute(
+                    'SELECT substr(deck, ?, ?) FROM quiz_sessions '
+                    'WHERE id = ?', (position * ITEM_SIZE + 1, ITEM_SIZE,
+                                     session_id)).fetchone()[0])[0]
+                position += 1
+            conn.execute(
+                'UPDATE quiz_sessions SET version = ?, position = ?, '
+                'expires_at = ? WHERE id = ?',
+                (session_version, position, time.time() + self.ttl,
+                 session_id))
+            conn.commit()
+            return size - position, question_id
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def sweep(self):
+        with self._connect() as conn:
+            return conn.execute(
+                'DELETE FROM quiz_sessions WHERE expires_at < ?',
+                (time.time(),)).rowcount
+
+
+def create_session_store(url, ttl=SESSION_TTL):
+    # 'memory' or 'sqlite:///path/to/sessions.db'
+    if url == 'memory':
+        return MemorySessionStore(ttl)
+    if url.startswith('sqlite:///'):
+        return SQLiteSessionStore(url[len('sqlite:///'):], ttl)
+    raise ValueError('unknown quiz session store {}'.format(url))
@@ -0,0 +1,217 @@
+import heapq
+import random
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import func, select, update
+
+from models import db, clear_category, Category, Question, QuestionIds
+from routing import shard_names
+
+# threads querying the shards of one request in parallel
+SHARD_WORKERS = 8
+
+'''
+ShardRouter
+    with DB_SHARDS set, the questions of each category live on one shard,
+    category % number of shards, and the primary database keeps the
+    categories, the bank version and the allocation of question ids.
+    Queries scoped to a category run on its shard only, the others run
+    on every shard in parallel on a thread pool and their rows, ordered
+    by id on each shard, are merged by id.
+
+    Queries are built as usual with Question.query and only executed
+    here: all() returns Question instances for queries of whole
+    questions, and rows for queries of some columns, so callers work
+    the same whether the bank is sharded or not.
+'''
+
+
+class ShardRouter(object):
+
+    def __init__(self, workers=SHARD_WORKERS):
+        self.workers = workers
+        self._executor = None
+
+    @property
+    def enabled(self):
+        return bool(current_app.config.get('DB_SHARDS'))
+
+    def engines(self, category=None):
+        # every shard, or only the one holding 'category'
+        engines = [db.get_engine(bind=name)
+                   for name in shard_names(current_app)]
+        if category is None:
+            return engines
+        return [engines[int(category) % len(engines)]]
+
+    def scatter(self, fn, engines):
+        # fn(engine) for each engine, in parallel
+        if len(engines) == 1:
+            return [fn(engines[0])]
+        if self._executor is None:
+            # imported by the first scatter, not on start
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return list(self._executor.map(fn, engines))
+
+    def shutdown(self):
+        # stops the threads, a forked worker starts its own
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def each(self, fn, category=None):
+        # fn(connection) in a transaction on each shard
+        def run(engine):
+            with engine.begin() as connection:
+                return fn(connection)
+        return self.scatter(run, self.engines(category))
+
+    def all(self, query, category=None, limit=None, reverse=False):
+        # the rows of 'query', which must be ordered by id (descending
+        # when 'reverse'), merged from the shards, at most 'limit'
+        statement = query.statement
+
+        def read(engine):
+            with engine.connect() as connection:
+                return connection.execute(statement).fetchall()
+
+        results = self.scatter(read, self.engines(category))
+        rows = heapq.merge(*results, key=lambda row: row.id,
+                           reverse=reverse)
+        rows = list(islice(rows, limit))
+        if _is_question_query(query):
+            return [Question.from_row(row) for row in rows]
+        return rows
+
+    def counts(self, query, category=None):
+        # (engine, number of rows of 'query') for each shard
+        statement = select([func.count()]).select_from(
+            query.order_by(None).statement.alias())
+
+        def count(engine):
+            with engine.connect() as connection:
+                return engine, connection.execute(statement).scalar()
+
+        return self.scatter(count, self.engines(category))
+
+    def count(self, query, category=None):
+        return sum(total for _, total in self.counts(query, category))
+
+    def random(self, query, category=None):
+        # a random row of 'query', or None: the shard is drawn by its
+        # number of rows, then the row at a random offset on it
+        counts = self.counts(query, category)
+        index = random.randrange(sum(total for _, total in counts) or 1)
+        for engine, total in counts:
+            if index < total:
+                statement = query.order_by(Question.id).offset(
+                    index).limit(1).statement
+                with engine.connect() as connection:
+                    row = connection.execute(statement).first()
+                return Question.from_row(row) if row is not None else None
+            index -= total
+        return None
+
+    def get(self, question_id):
+        rows = self.all(Question.query.filter(Question.id == question_id))
+        return rows[0] if rows else None
+
+    def allocate_ids(self, count):
+        # reserves 'count' consecutive ids on the primary database
+        table = QuestionIds.__table__
+        with db.engine.begin() as connection:
+            connection.execute(update(table).where(table.c.id == 1).values(
+                next_id=table.c.next_id + count))
+            next_id = connection.execute(select([table.c.next_id]).where(
+                table.c.id == 1)).scalar()
+        return list(range(next_id - count, next_id))
+
+    def insert(self, rows):
+        # inserts question dicts on the shards of their categories,
+        # returns their new ids
+        ids = self.allocate_ids(len(rows))
+        engines = self.engines()
+        by_engine = {}
+        for question_id, row in zip(ids, rows):
+            row = dict(row, id=question_id)
+            engine = engines[int(row.get('category') or 0) % len(engines)]
+            by_engine.setdefault(engine, []).append(row)
+
+        def write(engine):
+            with engine.begin() as connection:
+                connection.execute(Question.__table__.insert(),
+                                   by_engine[engine])
+
+        self.scatter(write, list(by_engine))
+        return ids
+
+    def copy_category(self, category):
+        # categories are copied to every shard, their questions refer
+        # to them
+        table = Category.__table__
+        # read here, the threads have no session to load them with
+        values = {'id': category.id, 'type': category.type}
+        self.each(lambda connection: connection.execute(
+            table.insert().values(**values)))
+
+    def delete_category(self, category):
+        table = Category.__table__
+        where = table.c.id == category.id
+
+        def delete(connection):
+            connection.execute(clear_category(category.id))
+            connection.execute(table.delete().where(where))
+
+        self.each(delete)
+
+    def sync_categories(self):
+        # copies the categories of the primary database missing on
+        # the shards, when shards are added
+        table = Category.__table__
+        categories = db.session.execute(select([table])).fetchall()
+
+        def copy(connection):
+            existing = set(row.id for row in connection.execute(
+                select([table.c.id])))
+            missing = [dict(row) for row in categories
+                       if row.id not in existing]
+            if missing:
+                connection.execute(table.insert(), missing)
+
+        self.each(copy)
+
+
+def _is_question_query(query):
+    descriptions = query.column_descriptions
+    # query(Question), rather than some of its columns
+    return len(descriptions) == 1 and descriptions[0]['type'] is Question
+
+
+shards = ShardRouter()
+
+
+'''
+fetch(query, category=None, limit=None, reverse=False)
+    the rows of a question query, from the shards when the bank is
+    sharded, else from the database as usual.
+'''
+
+
+def fetch(query, category=None, limit=None, reverse=False):
+    if shards.enabled:
+        return shards.all(query, category, limit, reverse)
+    return query.all()
+
+
+def count(query, category=None):
+    if shards.enabled:
+        return shards.count(query, category)
+    return query.count()
+
+
+def get_question(question_id):
+    if shards.enabled:
+        return shards.get(question_id)
+    return Question.query.get(question_id)
@@ -0,0 +1,40 @@
+from flask import abort
+
+from .quiz import MAX_QUIZ_BATCH
+
+'''
+Request validation
+    checks of the request bodies shared by the Flask app and the ASGI
+    app of flaskr/asgi.py. They abort() with the status of the error,
+    each app answers the HTTPException with its JSON error.
+'''
+
+QUESTION_COLUMNS = ('question', 'answer', 'category', 'difficulty')
+
+
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def get_new_question(body):
+    # the columns of a question to create, all of them are required
+    values = {column: body.get(column) for column in QUESTION_COLUMNS}
+    if not all(values.values()):
+        abort(400)
+    return values
+
+
+def get_quiz_category_id(body):
+    # 'click' is sent by the frontend when "All" is selected
+    category = body['quiz_category']
+    if category['type'] == 'click':
+        return None
+    return int(category['id'])
+
+
+def get_quiz_count(body):
+    # number of questions asked for, capped at MAX_QUIZ_BATCH
+    count = body.get('count', 1)
+    if not is_integer(count) or count < 1:
+        abort(400)
+    return min(count, MAX_QUIZ_BATCH)
@@ -0,0 +1,42 @@
+'''
+gunicorn settings for production, see wsgi.py:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+'''
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('TRIVIA_BIND', '0.0.0.0:8000')
+
+# the app, its caches and its indexes are loaded once in the master
+# and shared by the workers copy-on-write
+preload_app = True
+
+workers = int(os.environ.get(
+    'WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('TRIVIA_THREADS', 4))
+
+# connections the database accepts from all the workers together, each
+# worker keeps one per thread and may open the rest of its share; the
+# names start with '_' as gunicorn reads every other name as a setting
+_db_max_connections = int(os.environ.get('TRIVIA_DB_MAX_CONNECTIONS', 100))
+_db_connections_per_worker = max(1, _db_max_connections // workers)
+_db_pool_size = min(threads, _db_connections_per_worker)
+os.environ.setdefault('TRIVIA_DB_POOL_SIZE', str(_db_pool_size))
+os.environ.setdefault('TRIVIA_DB_MAX_OVERFLOW',
+                      str(_db_connections_per_worker - _db_pool_size))
+
+
+def pre_fork(server, worker):
+    # the objects of the master are left out of the garbage collections
+    # of the workers, which would otherwise write to, and so copy, every
+    # page holding them
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    import wsgi
+    wsgi.after_fork()
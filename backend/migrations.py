@@ -0,0 +1,278 @@
+import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import (
+    Column, DateTime, ForeignKey, Integer, MetaData, String, Table, inspect,
+    text)
+
+'''
+Migrations
+    versioned changes to the database schema. Each migration runs once,
+    in its own transaction, and is recorded in the schema_migrations
+    table. Migrations check the state of the schema before changing it,
+    so a database restored from trivia.psql or created by an earlier
+    version of the app is brought to the same schema.
+'''
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return fn
+    return register
+
+
+def questions_table(metadata, name='questions', **options):
+    # questions as of migration 2, integer category referencing categories
+    return Table(
+        name, metadata,
+        Column('id', Integer, primary_key=True),
+        Column('question', String),
+        Column('answer', String),
+        Column('category', Integer, ForeignKey(
+            'categories.id', onupdate='CASCADE', ondelete='SET NULL')),
+        Column('difficulty', Integer), **options)
+
+
+@migration(1, 'create categories and questions')
+def create_tables(conn):
+    metadata = MetaData()
+    Table('categories', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('type', String))
+    questions_table(metadata)
+    metadata.create_all(conn, checkfirst=True)
+
+
+@migration(2, 'make questions.category an integer foreign key')
+def type_question_category(conn):
+    inspector = inspect(conn)
+    category = [column for column in inspector.get_columns('questions')
+                if column['name'] == 'category'][0]
+    has_foreign_key = any(
+        key['referred_table'] == 'categories'
+        for key in inspector.get_foreign_keys('questions'))
+    if isinstance(category['type'], Integer) and has_foreign_key:
+        return
+
+    if conn.dialect.name == 'postgresql':
+        if not isinstance(category['type'], Integer):
+            conn.execute(text(
+                'ALTER TABLE questions ALTER COLUMN category TYPE integer '
+                'USING category::integer'))
+        if not has_foreign_key:
+            conn.execute(text(
+                'ALTER TABLE questions ADD CONSTRAINT category '
+                'FOREIGN KEY (category) REFERENCES categories (id) '
+                'ON UPDATE CASCADE ON DELETE SET NULL'))
+        return
+
+    # SQLite can not alter a column, the table is copied instead
+    metadata = MetaData()
+    Table('categories', metadata, Column('id', Integer, primary_key=True))
+    questions_table(metadata, 'questions_new').create(conn)
+    conn.execute(text(
+        'INSERT INTO questions_new (id, question, answer, category, '
+        'difficulty) SELECT id, question, answer, '
+        'CAST(category AS INTEGER), difficulty FROM questions'))
+    conn.execute(text('DROP TABLE questions'))
+    conn.execute(text('ALTER TABLE questions_new RENAME TO questions'))
+
+
+@migration(3, 'index questions on (category, id) and (category, difficulty)')
+def index_question_category(conn):
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_category_id '
+        'ON questions (category, id)'))
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_category_difficulty '
+        'ON questions (category, difficulty)'))
+
+
+def create_sqlite_fts(conn):
+    # FTS5 table over question and answer, kept in sync by triggers
+    conn.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5("
+        "question, answer, content='questions', content_rowid='id')"))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS questions_fts_insert "
+        "AFTER INSERT ON questions BEGIN "
+        "INSERT INTO questions_fts(rowid, question, answer) "
+        "VALUES (new.id, new.question, new.answer); END"))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS questions_fts_delete "
+        "AFTER DELETE ON questions BEGIN "
+        "INSERT INTO questions_fts(questions_fts, rowid, question, answer) "
+        "VALUES ('delete', old.id, old.question, old.answer); END"))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS questions_fts_update "
+        "AFTER UPDATE ON questions BEGIN "
+        "INSERT INTO questions_fts(questions_fts, rowid, question, answer) "
+        "VALUES ('delete', old.id, old.question, old.answer); "
+        "INSERT INTO questions_fts(rowid, question, answer) "
+        "VALUES (new.id, new.question, new.answer); END"))
+    conn.execute(text(
+        "INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')"))
+
+
+@migration(4, 'full text search index over question and answer')
+def index_question_text(conn):
+    if conn.dialect.name == 'postgresql':
+        # the expression must match the one searched in flaskr/search.py
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_questions_fts ON questions "
+            "USING gin (to_tsvector('english', coalesce(question, '') "
+            "|| ' ' || coalesce(answer, '')))"))
+    else:
+        create_sqlite_fts(conn)
+
+
+@migration(5, 'create question_bank holding the bank version')
+def create_question_bank(conn):
+    metadata = MetaData()
+    question_bank = Table(
+        'question_bank', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('version', Integer, nullable=False),
+        Column('updated_at', DateTime, nullable=False))
+    question_bank.create(conn, checkfirst=True)
+    if conn.execute(question_bank.select()).first() is None:
+        conn.execute(question_bank.insert().values(
+            id=1, version=0, updated_at=datetime.datetime.utcnow()))
+
+
+@migration(6, 'add questions.row_version')
+def add_question_row_version(conn):
+    columns = [column['name'] for column in
+               inspect(conn).get_columns('questions')]
+    if 'row_version' not in columns:
+        conn.execute(text(
+            'ALTER TABLE questions '
+            'ADD COLUMN row_version INTEGER NOT NULL DEFAULT 1'))
+
+
+@migration(7, 'create question_ids allocating ids across shards')
+def create_question_ids(conn):
+    metadata = MetaData()
+    question_ids = Table(
+        'question_ids', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('next_id', Integer, nullable=False))
+    question_ids.create(conn, checkfirst=True)
+    if conn.execute(question_ids.select()).first() is None:
+        last_id = conn.execute(text('SELECT MAX(id) FROM questions')).scalar()
+        conn.execute(question_ids.insert().values(
+            id=1, next_id=(last_id or 0) + 1))
+
+
+@migration(8, 'never hand out the id of a deleted question again')
+def autoincrement_question_ids(conn):
+    # SQLite gives the next question the id of the last one once it was
+    # deleted, unless the table is AUTOINCREMENT; the JSON fragments and
+    # the quiz decks are keyed by id. Postgres sequences never go back.
+    if conn.dialect.name != 'sqlite':
+        return
+    schema = conn.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' "
+        "AND name = 'questions'")).scalar()
+    if 'AUTOINCREMENT' in schema.upper():
+        return
+
+    # the table is copied, like in migration 2, its indexes and the
+    # triggers of the full text index go with the old one
+    metadata = MetaData()
+    Table('categories', metadata, Column('id', Integer, primary_key=True))
+    questions = questions_table(
+        metadata, 'questions_new', sqlite_autoincrement=True)
+    questions.append_column(Column(
+        'row_version', Integer, nullable=False, server_default='1'))
+    questions.create(conn)
+    conn.execute(text(
+        'INSERT INTO questions_new (id, question, answer, category, '
+        'difficulty, row_version) SELECT id, question, answer, category, '
+        'difficulty, row_version FROM questions'))
+    conn.execute(text('DROP TABLE questions'))
+    conn.execute(text('ALTER TABLE questions_new RENAME TO questions'))
+    index_question_category(conn)
+    create_sqlite_fts(conn)
+
+
+def upgrade(engine):
+    # applies the pending migrations, returns their versions
+    metadata = MetaData()
+    schema_migrations = Table(
+        'schema_migrations', metadata,
+        Column('version', Integer, primary_key=True),
+        Column('description', String),
+        Column('applied_at', DateTime))
+    metadata.create_all(engine, checkfirst=True)
+
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        with engine.connect() as conn:
+            sqlite = conn.dialect.name == 'sqlite'
+            if sqlite:
+                # tables are copied on SQLite, with the foreign keys
+                # off as the rows of an older database may point to
+                # deleted categories; set outside of the transaction
+                conn.execute(text('PRAGMA foreign_keys=OFF'))
+            try:
+                if migrate(conn, schema_migrations, version, description,
+                           fn):
+                    applied.append(version)
+            finally:
+                if sqlite:
+                    conn.execute(text('PRAGMA foreign_keys=ON'))
+
+    return applied
+
+
+def migrate(conn, schema_migrations, version, description, fn):
+    # applies one migration in a transaction unless it already was,
+    # returns whether it was applied
+    with conn.begin():
+        if conn.dialect.name == 'postgresql':
+            # one process migrates at a time, the others wait and then
+            # find the migration applied
+            conn.execute(text('SELECT pg_advisory_xact_lock(8482)'))
+        done = conn.execute(schema_migrations.select().where(
+            schema_migrations.c.version == version)).first()
+        if done is not None:
+            return False
+
+        fn(conn)
+        conn.execute(schema_migrations.insert().values(
+            version=version, description=description,
+            applied_at=datetime.datetime.utcnow()))
+        return True
+
+
+@click.group('db')
+def db_cli():
+    '''Manage the database schema.'''
+
+
+@db_cli.command('upgrade')
+@with_appcontext
+def upgrade_command():
+    '''Apply the pending schema migrations.'''
+    from flaskr.sharding import shards
+    from models import db
+    from routing import shard_names
+
+    applied = upgrade(db.engine)
+    if applied:
+        for version in applied:
+            click.echo('applied migration {}'.format(version))
+    else:
+        click.echo('database is up to date')
+    for name in shard_names(db.get_app()):
+        for version in upgrade(db.get_engine(bind=name)):
+            click.echo('applied migration {} to {}'.format(version, name))
+    # shards have the whole schema, categories are copied to them
+    if shards.enabled:
+        shards.sync_categories()
@@ -1,8 +1,11 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, \
+    Index, event, orm
 from flask_sqlalchemy import SQLAlchemy
 import json
 from config import db_details
+from pool import create_instrumented_engine, engine_options
+from routing import RoutingSession, replica_binds, shard_binds
 
 # database_name = "trivia"
 database_path = "postgres://{}:{}@{}/{}".format(
@@ -12,20 +15,67 @@ database_path = "postgres://{}:{}@{}/{}".format(
     db_details["prod_db_name"]
     )
 
-db = SQLAlchemy()
+
+def enable_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces foreign keys, and sets the category of the
+    # questions of a deleted category to NULL, when asked to on each
+    # connection
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+class Database(SQLAlchemy):
+
+    def create_engine(self, sa_url, engine_opts):
+        # engines with pools reporting their wait times, see pool.py
+        engine = create_instrumented_engine(sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', enable_foreign_keys)
+        return engine
+
+    def create_session(self, options):
+        # sessions which can read from a replica, see routing.py
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = Database()
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, without
+    connecting: the engines are created by the first query and the
+    schema is migrated by `flask db upgrade`
 '''
 
 
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app.config, database_path)
+    # replicas are bound but never migrated, they follow the primary
+    app.config["SQLALCHEMY_BINDS"] = replica_binds(
+        app.config.get("DB_REPLICAS", []))
+    app.config["SQLALCHEMY_BINDS"].update(shard_binds(
+        app.config.get("DB_SHARDS", [])))
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+
+def get_engines(app):
+    # the engines of the primary database and of every bind
+    return [db.get_engine(app)] + [
+        db.get_engine(app, bind=name)
+        for name in app.config.get("SQLALCHEMY_BINDS") or {}]
+
+
+def dispose_engines(app):
+    # closes the pooled connections, a forked worker must not share the
+    # sockets of its parent
+    db.session.remove()
+    for engine in get_engines(app):
+        engine.dispose()
 
 
 '''
@@ -35,11 +85,23 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+        # ids are never handed out again, see migration 8
+        {'sqlite_autoincrement': True}
+    )
+
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey(
+        'categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
+    # incremented by every update, versions the cached JSON of a question
+    row_version = Column(Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': row_version}
 
     def __init__(self, question, answer, category, difficulty):
         self.question = question
@@ -47,6 +109,16 @@ class Question(db.Model):
         self.category = category
         self.difficulty = difficulty
 
+    @classmethod
+    def from_row(cls, row):
+        # a detached question for a row read outside the session, from
+        # a shard or the async driver
+        question = cls(row['question'], row['answer'], row['category'],
+                       row['difficulty'])
+        question.id = row['id']
+        question.row_version = row['row_version']
+        return question
+
     def insert(self):
         db.session.add(self)
         db.session.commit()
@@ -68,6 +140,14 @@ class Question(db.Model):
         }
 
 
+def clear_category(category_id):
+    # the UPDATE taking the questions out of a category about to be
+    # deleted, with a new row_version as their JSON changes
+    table = Question.__table__
+    return table.update().where(table.c.category == category_id).values(
+        category=None, row_version=table.c.row_version + 1)
+
+
 '''
 Category
 
@@ -79,6 +159,11 @@ class Category(db.Model):
 
     id = Column(Integer, primary_key=True)
     type = Column(String)
+    # delete() sets the category of the questions to NULL, the database
+    # does too for categories deleted by other means
+    questions = db.relationship(
+        'Question', backref='category_ref', lazy='dynamic',
+        passive_deletes=True)
 
     def __init__(self, type):
         self.type = type
@@ -88,6 +173,7 @@ class Category(db.Model):
         db.session.commit()
 
     def delete(self):
+        db.session.execute(clear_category(self.id))
         db.session.delete(self)
         db.session.commit()
 
@@ -96,3 +182,32 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
         }
+
+
+'''
+QuestionBank
+    a single row holding the version of the question bank, every write
+    to questions or categories increments it
+'''
+
+
+class QuestionBank(db.Model):
+    __tablename__ = 'question_bank'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+'''
+QuestionIds
+    the next question id, questions spread over shards take their ids
+    from this row of the primary database.
+'''
+
+
+class QuestionIds(db.Model):
+    __tablename__ = 'question_ids'
+
+    id = Column(Integer, primary_key=True)
+    next_id = Column(Integer, nullable=False)
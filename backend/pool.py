@@ -0,0 +1,169 @@
+import threading
+import time
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.pool import NullPool
+
+'''
+Connection pool
+    engine options built from the app config, and pools which record
+    how long each checkout waited for a connection. Set DB_POOL to
+    'null' to open a connection per checkout, behind an external pooler
+    like PgBouncer. The sizes do not apply to SQLite, which keeps the
+    pools Flask-SQLAlchemy picks for it.
+'''
+
+# the defaults of SQLAlchemy's QueuePool
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+POOL_TIMEOUT = 30
+# test a connection before handing it out, survives database restarts
+POOL_PRE_PING = True
+# seconds after which a connection is replaced, -1 keeps it forever
+POOL_RECYCLE = -1
+
+# upper bounds of the wait time histogram, in seconds
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+def engine_options(config, database_path):
+    # SQLALCHEMY_ENGINE_OPTIONS for the DB_POOL* settings of 'config'
+    options = {
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', POOL_PRE_PING),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', POOL_RECYCLE)
+    }
+    if config.get('DB_POOL', 'queue') == 'null':
+        options['poolclass'] = NullPool
+    elif not database_path.startswith('sqlite'):
+        options.update(
+            pool_size=config.get('DB_POOL_SIZE', POOL_SIZE),
+            max_overflow=config.get('DB_MAX_OVERFLOW', MAX_OVERFLOW),
+            pool_timeout=config.get('DB_POOL_TIMEOUT', POOL_TIMEOUT))
+    return options
+
+
+'''
+PoolStats
+    checkouts, timeouts and connections currently checked out of a pool,
+    with a histogram of the time each checkout waited.
+'''
+
+
+class PoolStats(object):
+
+    def __init__(self, buckets=WAIT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.checked_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def checkout(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            for index, bound in enumerate(self.buckets):
+                if wait <= bound:
+                    break
+            else:
+                index = len(self.buckets)
+            self.counts[index] += 1
+
+    def checkin(self):
+        with self._lock:
+            self.checked_out -= 1
+
+    def timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def histogram(self):
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        return dict(zip(bounds, self.counts))
+
+    def stats(self):
+        return {
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'checked_out': self.checked_out,
+            'wait_seconds': {
+                'buckets': self.histogram(),
+                'total': round(self.wait_total, 6),
+                'max': round(self.wait_max, 6)
+            }
+        }
+
+
+class InstrumentedPool(object):
+    # mixed in before a pool class, see instrumented()
+
+    def _do_get(self):
+        # QueuePool._do_get calls itself again after a race, only the
+        # outer call is timed
+        depth = getattr(self._calls, 'depth', 0)
+        self._calls.depth = depth + 1
+        start = time.monotonic()
+        try:
+            record = super(InstrumentedPool, self)._do_get()
+        except exc.TimeoutError:
+            if not depth:
+                self.stats.timeout()
+            raise
+        finally:
+            self._calls.depth = depth
+        if not depth:
+            self.stats.checkout(time.monotonic() - start)
+        return record
+
+    def _do_return_conn(self, record):
+        self.stats.checkin()
+        super(InstrumentedPool, self)._do_return_conn(record)
+
+
+def instrumented(pool_class):
+    # a subclass of 'pool_class' with its own PoolStats, kept by the
+    # pools the engine recreates on dispose()
+    return type('Instrumented' + pool_class.__name__,
+                (InstrumentedPool, pool_class),
+                {'pool_class': pool_class, 'stats': PoolStats(),
+                 '_calls': threading.local()})
+
+
+def create_instrumented_engine(sa_url, options):
+    pool_class = options.get('poolclass') or \
+        sa_url.get_dialect().get_pool_class(sa_url)
+    return create_engine(
+        sa_url, **dict(options, poolclass=instrumented(pool_class)))
+
+
+def warm_pool(engine, count):
+    # opens 'count' connections and returns them to the pool, so the
+    # first requests do not pay for connecting
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {'class': getattr(pool, 'pool_class', type(pool)).__name__}
+    if hasattr(pool, 'checkedout'):
+        # QueuePool, overflow() counts up from -size
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,
+            timeout=pool._timeout)
+    if isinstance(pool, InstrumentedPool):
+        stats.update(pool.stats.stats())
+    return stats
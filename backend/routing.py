@@ -0,0 +1,121 @@
+import functools
+import random
+import time
+from contextlib import contextmanager
+
+from flask import current_app, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy.sql.expression import UpdateBase
+
+'''
+Read replicas
+    DB_REPLICAS lists the URIs of read replicas of the primary database,
+    they become the binds 'replica_0', 'replica_1', ... The views wrapped
+    with replica_reads send their queries to a random replica, every
+    write goes to the primary. A client which wrote is sent a cookie
+    pinning its reads to the primary for READ_YOUR_WRITES seconds, the
+    time replicas may take to catch up.
+'''
+
+REPLICA_BIND = 'replica_{}'
+READ_YOUR_WRITES = 5
+PRIMARY_COOKIE = 'trivia_primary_until'
+
+
+def replica_binds(uris):
+    # SQLALCHEMY_BINDS for the replica URIs
+    return {REPLICA_BIND.format(index): uri
+            for index, uri in enumerate(uris)}
+
+
+'''
+Shards
+    DB_SHARDS lists the URIs of the databases holding the questions,
+    they become the binds 'shard_0', 'shard_1', ... See flaskr/sharding.py.
+'''
+
+SHARD_BIND = 'shard_{}'
+
+
+def shard_binds(uris):
+    # SQLALCHEMY_BINDS for the shard URIs
+    return {SHARD_BIND.format(index): uri
+            for index, uri in enumerate(uris)}
+
+
+def shard_names(app):
+    # the shard binds of 'app' in order, empty when not sharded
+    return [SHARD_BIND.format(index)
+            for index in range(len(app.config.get('DB_SHARDS') or []))]
+
+
+'''
+RoutingSession
+    the session of Flask-SQLAlchemy, sending reads to 'replica' when it
+    is set. Flushes and INSERT, UPDATE and DELETE statements always go
+    to the primary, and mark the session as having written.
+'''
+
+
+class RoutingSession(SignallingSession):
+
+    def __init__(self, db, **options):
+        self.replica = None
+        self.wrote = False
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.wrote = True
+        elif self.replica is not None:
+            return self.replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+@contextmanager
+def on_primary(session):
+    # reads of the block go to the primary, like loading the caches
+    # shared by all clients, which must not be built from a replica
+    # that is behind
+    replica, session.replica = session.replica, None
+    try:
+        yield session
+    finally:
+        session.replica = replica
+
+
+def _pinned_to_primary():
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def use_replica():
+    # sends the reads of the current request to a replica, unless
+    # there are none or the client wrote a moment ago
+    binds = current_app.config.get('SQLALCHEMY_BINDS') or {}
+    names = [name for name in binds
+             if name.startswith(REPLICA_BIND.format(''))]
+    if not names or _pinned_to_primary():
+        return
+    db = current_app.extensions['sqlalchemy'].db
+    db.session().replica = db.get_engine(bind=random.choice(names))
+
+
+def replica_reads(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        use_replica()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def read_your_writes(response):
+    # after_request hook, pins the reads of a client which just wrote
+    db = current_app.extensions['sqlalchemy'].db
+    if db.session.registry.has() and getattr(db.session(), 'wrote', False):
+        window = current_app.config.get('READ_YOUR_WRITES', READ_YOUR_WRITES)
+        response.set_cookie(PRIMARY_COOKIE, str(time.time() + window),
+                            max_age=window, httponly=True)
+    return response
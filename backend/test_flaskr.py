@@ -1,10 +1,25 @@
+import asyncio
 import os
 import unittest
 import json
+import gzip
+import io
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from types import SimpleNamespace
 from flask_sqlalchemy import SQLAlchemy
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from asgi_client import asgi_request
+from flaskr import asgi, bulk, create_app
+from flaskr.cache import CategoryCache, bank_version
+from flaskr.quiz import question_pool
+from flaskr.search import SearchIndex, TrigramIndex, search_index, trigram_index
+from flaskr.serialization import FragmentCache, fragment_cache
+from flaskr.sessions import SQLiteSessionStore
+from models import Question, Category
 from config import db_details
 from flask import request
 
@@ -12,13 +27,19 @@ from flask import request
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
+    database_name = db_details["test_db_name"]
+    database_path = "postgres://{}:{}@{}/{}".format(db_details["user"], db_details["password"], 'localhost:5432', database_name)
+
+    @classmethod
+    def setUpClass(cls):
+        """Apply the migrations once, as is done before deploying."""
+        app = create_app({'SQLALCHEMY_DATABASE_URI': cls.database_path})
+        app.test_cli_runner().invoke(args=['db', 'upgrade'])
+
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
         self.client = self.app.test_client
-        self.database_name = db_details["test_db_name"]
-        self.database_path = "postgres://{}:{}@{}/{}".format(db_details["user"], db_details["password"], 'localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
 
         self.new_question = {
             'question': 'This is a test question',
@@ -38,6 +59,23 @@ class TriviaTestCase(unittest.TestCase):
         """Executed after reach test"""
         pass
 
+    def create_sqlite_app(self, replicas=0, shards=0):
+        """Create and migrate an app on the SQLite files 'primary.db', 'replica_<n>.db'
+        and 'shard_<n>.db' of a new directory, removed after the test whether it
+        passed or not. Returns (app, directory)."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        def uri(name):
+            return 'sqlite:///' + os.path.join(directory, name + '.db')
+
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': uri('primary'),
+            'DB_REPLICAS': [uri('replica_{}'.format(index)) for index in range(replicas)],
+            'DB_SHARDS': [uri('shard_{}'.format(index)) for index in range(shards)]})
+        app.test_cli_runner().invoke(args=['db', 'upgrade'])
+        return app, directory
+
     """
     TODO-DONE
     Write at least one test for each test for successful operation and for expected errors.
@@ -56,6 +94,137 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(len(data['categories']))
 
+    def test_get_questions_per_page(self):
+        ''' Test page size given with per_page and its upper limit '''
+        res = self.client().get('/questions?per_page=2')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['questions']), 2)
+        self.assertTrue(data['total_questions'])
+
+        res = self.client().get('/questions?per_page=100000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data['questions']) <= 100)
+
+    def test_get_questions_from_fragment_cache(self):
+        ''' Test a page served from cached fragments is identical '''
+        first = self.client().get('/questions?per_page=5')
+        second = self.client().get('/questions?per_page=5')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(json.loads(first.data), json.loads(second.data))
+
+        res = self.client().get('/admin/cache')
+        data = json.loads(res.data)
+
+        self.assertTrue(data['caches']['fragments']['hits'] >= 5)
+
+    def test_fragment_cache_keeps_recently_used(self):
+        ''' Test the fragment cache evicts the least recently used question '''
+        cache = FragmentCache(size=2)
+        questions = [SimpleNamespace(id=question_id, row_version=1, format=lambda: {})
+                     for question_id in range(3)]
+        cache.fragment(questions[0])
+        cache.fragment(questions[1])
+        cache.fragment(questions[0])
+        cache.fragment(questions[2])
+
+        self.assertEqual([key[0] for key in cache._fragments], [0, 2])
+
+    def test_get_questions_with_fields(self):
+        ''' Test sparse fieldsets and answer-free pages '''
+        res = self.client().get('/questions?fields=id,question')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for question in data['questions']:
+            self.assertEqual(set(question), {'id', 'question'})
+
+        res = self.client().get('/categories/3/questions?include_answers=false')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for question in data['questions']:
+            self.assertFalse('answer' in question)
+
+    def test_400_get_questions_unknown_field(self):
+        ''' Test sparse fieldsets with a field questions do not have '''
+        res = self.client().get('/questions?fields=id,secret')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_questions_with_cursor(self):
+        ''' Test keyset pagination by following next_cursor '''
+        res = self.client().get('/questions?cursor=&per_page=2')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['questions']), 2)
+        self.assertTrue(data['next_cursor'])
+        self.assertEqual(data['prev_cursor'], None)
+
+        first_page_ids = [question['id'] for question in data['questions']]
+        res = self.client().get(
+            '/questions?per_page=2&cursor={}'.format(data['next_cursor']))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['prev_cursor'])
+        self.assertTrue(
+            data['questions'][0]['id'] > max(first_page_ids))
+
+    def test_400_questions_with_invalid_cursor(self):
+        ''' Test keyset pagination with a cursor that was not issued '''
+        res = self.client().get('/questions?cursor=not-a-cursor')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_304_questions_not_modified(self):
+        ''' Test conditional GET with the ETag of the previous response,
+            the ETag changes once a question was added
+        '''
+        res = self.client().get('/questions')
+        etag = res.headers.get('ETag')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(etag)
+
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        self.client().post('/questions', json=self.new_question)
+
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers.get('ETag'), etag)
+
+    def test_get_questions_gzip(self):
+        ''' Test questions are gzipped for clients which accept it,
+            and the compressed ETag still gives a 304
+        '''
+        res = self.client().get('/questions?per_page=20', headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['questions']))
+
+        res = self.client().get('/questions?per_page=20', headers={
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': res.headers.get('ETag')})
+        self.assertEqual(res.status_code, 304)
+
     def test_404_questions_not_available(self):
         ''' Test all questions with no existing page'''
         res = self.client().get('/questions?page=1000')
@@ -81,7 +250,8 @@ class TriviaTestCase(unittest.TestCase):
         ''' Test on POST request to create new question '/questions' '''
         
 
-        res = self.client().post('/questions', json=self.new_question)
+        res = self.client().post('/questions', json=self.new_question,
+                                 headers={'Prefer': 'return=representation'})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -89,6 +259,209 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(len(data['questions']))
 
+    def test_create_question_minimal(self):
+        ''' Test a created question is answered with its id and the new version only '''
+        res = self.client().post('/questions', json=self.new_question)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Preference-Applied'], 'return=minimal')
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['created'])
+        self.assertTrue(data['version'])
+        self.assertFalse('questions' in data)
+
+    def test_bulk_import_questions(self):
+        ''' Test NDJSON bulk import with a per-row error report '''
+        rows = [
+            {'question': 'Bulk question', 'answer': 'Bulk', 'category': 5, 'difficulty': 1},
+            {'question': 'Bulk question', 'answer': 'Bulk', 'category': 'Art', 'difficulty': 2},
+            {'question': 'Bulk question', 'answer': '', 'category': 5, 'difficulty': 1}
+        ]
+        body = '\n'.join(json.dumps(row) for row in rows) + '\n{not json\n'
+        res = self.client().post('/questions/bulk', data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual([error['row'] for error in data['errors']], [3, 4])
+
+    def test_bulk_import_csv(self):
+        ''' Test CSV bulk import '''
+        body = 'question,answer,category,difficulty\nBulk CSV question,Bulk,5,3\n'
+        res = self.client().post('/questions/bulk?format=csv', data=body)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['errors'], [])
+
+    def test_bulk_parsers_split_rows_on_newlines_only(self):
+        ''' Test line separators inside JSON strings and CSV fields, and a CRLF cut by the end of a read '''
+        first = json.dumps({'question': 'x' * (bulk.READ_SIZE - 20)})
+        first += ' ' * (bulk.READ_SIZE - 1 - len(first)) + '\r\n'
+        body = first + json.dumps({'question': 'a\u2028b\x85c'}, ensure_ascii=False) + '\r\n{not json\r\n'
+        rows = list(bulk.parse_ndjson(io.BytesIO(body.encode())))
+
+        self.assertEqual([row for row, _ in rows], [1, 2, 3])
+        self.assertEqual(rows[1][1], {'question': 'a\u2028b\x85c'})
+        self.assertTrue(isinstance(rows[2][1], bulk.RowError))
+
+        body = 'question,answer\r\n"a\u2028b\x0cc",x\r\n"two\r\nlines",y\r\n'
+        rows = list(bulk.parse_csv(io.BytesIO(body.encode())))
+
+        self.assertEqual([record for _, record in rows], [
+            {'question': 'a\u2028b\x0cc', 'answer': 'x'},
+            {'question': 'two\r\nlines', 'answer': 'y'}])
+
+    def test_400_bulk_import_unknown_format(self):
+        ''' Test bulk import of a body in an unknown format '''
+        res = self.client().post('/questions/bulk', data='question', content_type='text/plain')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_export_questions(self):
+        ''' Test NDJSON export of all questions and CSV export with filters '''
+        res = self.client().get('/questions/export')
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(rows))
+        self.assertEqual(rows, sorted(rows, key=lambda row: row['id']))
+
+        since_id = rows[0]['id']
+        res = self.client().get('/questions/export?format=csv&category=3&since_id={}'.format(since_id))
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty')
+        for line in lines[1:]:
+            self.assertTrue(int(line.split(',')[0]) > since_id)
+
+    def test_400_export_unknown_format(self):
+        ''' Test export in a format which is not supported '''
+        res = self.client().get('/questions/export?format=xml')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_bulk_update_and_delete_questions(self):
+        ''' Test moving questions to another category then deleting them '''
+        ids = []
+        for _ in range(3):
+            res = self.client().post('/questions', json=self.new_question)
+            ids.append(json.loads(res.data)['created'])
+
+        res = self.client().patch('/questions/bulk', json={'ids': ids, 'set': {'category': 6, 'difficulty': 5}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 3)
+        self.assertEqual(data['ids'], ids)
+
+        res = self.client().post('/questions/bulk-delete', json={'ids': ids, 'filter': {'difficulty': 5}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 3)
+
+        res = self.client().post('/questions/bulk-delete', json={'ids': ids})
+        self.assertEqual(res.status_code, 404)
+
+    def test_bulk_writes_update_indexes(self):
+        ''' Test bulk import, update and delete are applied to the indexes without rebuilding them '''
+        self.client().post('/questions', json={'searchTerm': 'test question', 'mode': 'ranked'})
+        with self.app.app_context():
+            question_pool.ids()
+        misses = search_index.misses, question_pool.misses
+
+        rows = [{'question': 'Where does the quokka live?', 'answer': 'Australia', 'category': 5, 'difficulty': 1}] * 2
+        res = self.client().post('/questions/bulk', data='\n'.join(json.dumps(row) for row in rows),
+                                 content_type='application/x-ndjson')
+        self.assertEqual(json.loads(res.data)['imported'], 2)
+        res = self.client().post('/questions', json={'searchTerm': 'quokka', 'mode': 'ranked'})
+        ids = [question['id'] for question in json.loads(res.data)['questions']]
+        self.assertEqual(len(ids), 2)
+
+        res = self.client().patch('/questions/bulk', json={'ids': ids, 'set': {'category': 6}})
+        self.assertEqual(json.loads(res.data)['ids'], ids)
+        with self.app.app_context():
+            self.assertTrue(set(ids) <= set(question_pool.ids(6)))
+            self.assertFalse(set(ids) & set(question_pool.ids(5)))
+
+        res = self.client().post('/questions/bulk-delete', json={'ids': ids})
+        self.assertEqual(json.loads(res.data)['ids'], ids)
+        res = self.client().post('/questions', json={'searchTerm': 'quokka', 'mode': 'ranked'})
+        self.assertEqual(res.status_code, 404)
+        with self.app.app_context():
+            self.assertFalse(set(ids) & set(question_pool.ids()))
+        self.assertEqual((search_index.misses, question_pool.misses), misses)
+
+    def test_400_bulk_delete_without_criteria(self):
+        ''' Test bulk delete refuses to delete every question '''
+        res = self.client().post('/questions/bulk-delete', json={'filter': {}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_patch_question(self):
+        ''' Test partial update of a question with its row_version '''
+        res = self.client().post('/questions', json=self.new_question)
+        question_id = json.loads(res.data)['created']
+
+        res = self.client().patch('/questions/{}'.format(question_id), json={'difficulty': 3, 'row_version': 1},
+                                  headers={'Prefer': 'return=representation'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['row_version'], 2)
+        self.assertEqual(data['question']['difficulty'], 3)
+        self.assertEqual(data['question']['answer'], self.new_question['answer'])
+
+        # the question is no longer at version 1
+        res = self.client().patch('/questions/{}'.format(question_id), json={'difficulty': 4, 'row_version': 1})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['message'], 'conflict')
+
+    def test_patch_question_updates_indexes(self):
+        ''' Test an edited question is found by its new text without rebuilding the indexes '''
+        res = self.client().post('/questions', json=self.new_question)
+        question_id = json.loads(res.data)['created']
+        for mode in ('ranked', 'fuzzy'):
+            self.client().post('/questions', json={'searchTerm': 'test question', 'mode': mode})
+        with self.app.app_context():
+            question_pool.ids()
+        misses = search_index.misses, trigram_index.misses, question_pool.misses
+
+        self.client().patch('/questions/{}'.format(question_id), json={
+            'question': 'Which zebra is striped?', 'category': 6})
+
+        for mode in ('ranked', 'fuzzy'):
+            res = self.client().post('/questions', json={'searchTerm': 'zebra', 'mode': mode})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([question['id'] for question in json.loads(res.data)['questions']], [question_id])
+        with self.app.app_context():
+            self.assertIn(question_id, question_pool.ids(6))
+            self.assertNotIn(question_id, question_pool.ids(5))
+        self.assertEqual((search_index.misses, trigram_index.misses, question_pool.misses), misses)
+
+    def test_404_patch_question_not_found(self):
+        ''' Test partial update of a question which does not exist '''
+        res = self.client().patch('/questions/100000', json={'difficulty': 3})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     def test_404_create_question_with_missing_details(self):
         ''' Test on POST request to create new question with missing details '/questions' '''
         incomplete_question = {
@@ -114,6 +487,67 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['questions']))
         self.assertTrue(data['total_questions'])
 
+    def test_search_question_ranked(self):
+        ''' Test on ranked search over question and answer text,
+            a question inserted before is found right away
+        '''
+        self.client().post('/questions', json={
+            'question': 'Which zeppelin crossed the ocean first?',
+            'answer': 'Graf Zeppelin',
+            'category': 4,
+            'difficulty': 2
+        })
+
+        res = self.client().post('/questions', json={
+            'searchTerm': 'Zeppelin ocean', 'mode': 'ranked'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['total_questions'])
+        self.assertTrue('zeppelin' in data['questions'][0]['question'].lower())
+
+    def test_404_question_ranked_search_not_found(self):
+        ''' Test on ranked search with terms that are not in any question '''
+        res = self.client().post('/questions', json={
+            'searchTerm': 'qwertyuiop asdfghjkl', 'mode': 'ranked'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_search_question_fuzzy(self):
+        ''' Test on fuzzy search with a misspelled search term '''
+        self.client().post('/questions', json={
+            'question': 'What is the capital of Zanzibar?',
+            'answer': 'Zanzibar City',
+            'category': 3,
+            'difficulty': 2
+        })
+
+        res = self.client().post('/questions', json={
+            'searchTerm': 'zanzbar', 'mode': 'fuzzy'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['total_questions'])
+        self.assertTrue('Zanzibar' in data['questions'][0]['question'])
+
+    def test_search_question_fuzzy_keeps_substring_matches(self):
+        ''' Test on fuzzy search, every substring match is found first '''
+        res = self.client().post('/questions?per_page=100', json={'searchTerm': 'title'})
+        substring_ids = [question['id'] for question in json.loads(res.data)['questions']]
+
+        res = self.client().post('/questions?per_page=100', json={
+            'searchTerm': 'title', 'mode': 'fuzzy'})
+        data = json.loads(res.data)
+        fuzzy_ids = [question['id'] for question in data['questions']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(fuzzy_ids[:len(substring_ids)], substring_ids)
+
     def test_404_question_with_search_term_not_found(self):
         ''' Test on POST request to search with a search term that does not exist '''
         res = self.client().post('/questions', json={'searchTerm': 'This would definitely not present'})
@@ -179,6 +613,145 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['question']['id'] not in quiz_details['previous_questions'])
 
 
+    def test_play_quiz_all_categories(self):
+        ''' Test on POST request on play_quiz with "All" categories '''
+        quiz_details = {
+            'previous_questions': [1, 3],
+            'quiz_category': {
+                'type': 'click',
+                'id': 0
+            }
+        }
+
+        res = self.client().post('/quizzes', json=quiz_details)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['question']['question'])
+        self.assertTrue(data['question']['id'] not in quiz_details['previous_questions'])
+
+    def test_play_quiz_with_count(self):
+        ''' Test on play_quiz asking for several questions at once '''
+        quiz_details = {
+            'previous_questions': [1, 3],
+            'count': 5,
+            'quiz_category': {
+                'type': 'click',
+                'id': 0
+            }
+        }
+
+        res = self.client().post('/quizzes', json=quiz_details)
+        data = json.loads(res.data)
+        played = [question['id'] for question in data['questions']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(played), 5)
+        self.assertEqual(len(set(played)), 5)
+        self.assertEqual(data['question']['id'], played[0])
+        self.assertFalse(set(played) & set(quiz_details['previous_questions']))
+
+    def test_400_play_quiz_with_invalid_count(self):
+        ''' Test on play_quiz with a count which is not a positive integer '''
+        quiz_details = {
+            'previous_questions': [],
+            'count': 0,
+            'quiz_category': {
+                'type': 'click',
+                'id': 0
+            }
+        }
+
+        res = self.client().post('/quizzes', json=quiz_details)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_play_quiz_category_exhausted(self):
+        ''' Test on play_quiz once every question of a category was played '''
+        res = self.client().get('/categories/3/questions?per_page=100')
+        played = [question['id'] for question in json.loads(res.data)['questions']]
+
+        quiz_details = {
+            'previous_questions': played,
+            'quiz_category': {
+                'type': 'Geography',
+                'id': 3
+            }
+        }
+        res = self.client().post('/quizzes', json=quiz_details)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question'], None)
+
+    def test_play_seeded_quiz(self):
+        ''' Test on play_quiz with a seed, following the returned token
+            plays the same questions in the same order every time
+        '''
+        quiz_details = {
+            'seed': 1521,
+            'quiz_category': {
+                'type': 'Geography',
+                'id': 3
+            }
+        }
+
+        rounds = []
+        for _ in range(2):
+            res = self.client().post('/quizzes', json=quiz_details)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['success'], True)
+
+            played = []
+            while data['question']:
+                played.append(data['question']['id'])
+                res = self.client().post('/quizzes', json={'token': data['token']})
+                data = json.loads(res.data)
+            rounds.append(played)
+
+        self.assertTrue(len(rounds[0]))
+        self.assertEqual(len(set(rounds[0])), len(rounds[0]))
+        self.assertEqual(rounds[0], rounds[1])
+
+    def test_seeded_quiz_order_kept_when_bank_changes(self):
+        ''' Test on play_quiz with a token, a question added during the quiz does not reorder the deck '''
+        quiz_details = {'seed': 77, 'quiz_category': {'type': 'Geography', 'id': 3}}
+
+        def play(data, played):
+            while data['question']:
+                played.append(data['question']['id'])
+                res = self.client().post('/quizzes', json={'token': data['token']})
+                data = json.loads(res.data)
+            return played
+
+        expected = play(json.loads(self.client().post('/quizzes', json=quiz_details).data), [])
+
+        data = json.loads(self.client().post('/quizzes', json=quiz_details).data)
+        played = [data['question']['id']]
+        res = self.client().post('/questions', json=dict(self.new_question, category=3))
+        created = json.loads(res.data)['created']
+        res = self.client().post('/quizzes', json={'token': data['token']})
+        played = play(json.loads(res.data), played)
+        self.client().delete('/questions/{}'.format(created))
+
+        self.assertEqual(played, expected)
+
+    def test_400_play_quiz_with_invalid_token(self):
+        ''' Test on play_quiz with a deck token that was not signed by the API '''
+        res = self.client().post('/quizzes', json={'token': 'not-a-token'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
     def test_405_wrong_method_on_quiz(self):
         ''' Test on wrong method request on play_quiz ex - get, patch, etc...'''
         res = self.client().get('/quizzes')
@@ -200,6 +773,74 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'bad request')
 
+    # -----------------------------------------------------------------#
+    # Test on 'POST' '/quizzes/sessions'
+    # -----------------------------------------------------------------#
+
+    def test_play_quiz_session(self):
+        ''' Test on a quiz session, every question is played once '''
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'Geography', 'id': 3}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['session_id'])
+        self.assertTrue(data['total_questions'])
+
+        played = []
+        for _ in range(data['total_questions']):
+            res = self.client().post(
+                '/quizzes/sessions/{}/next'.format(data['session_id']))
+            question = json.loads(res.data)['question']
+            self.assertEqual(res.status_code, 200)
+            if question is None:
+                break
+            self.assertEqual(question['category'], 3)
+            self.assertTrue(question['id'] not in played)
+            played.append(question['id'])
+
+        self.assertTrue(len(played))
+
+    def test_quiz_session_store_shuffles_in_added_questions(self):
+        ''' Test on a stored session, questions added mid-quiz are played once and the deck keeps its played ids '''
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = SQLiteSessionStore(os.path.join(directory, 'sessions.db'))
+        session = store.create(3, array('l', [2, 7, 5]))
+
+        remaining, first = store.draw(session.id)
+        self.assertEqual(remaining, 2)
+        version = session.version + 1
+        remaining, second = store.pop(session.id, array('l', [5, 8, 9]), version)
+        self.assertEqual(remaining, 3)
+        played = [first, second] + [
+            store.pop(session.id, None, version)[1] for _ in range(3)]
+
+        self.assertEqual(sorted(played), [2, 5, 7, 8, 9])
+        self.assertEqual(store.pop(session.id, None, version), (0, None))
+        self.assertEqual(store.peek(session.id).max_id, 9)
+
+        store.close()
+
+    def test_404_quiz_session_not_found(self):
+        ''' Test on drawing a question from a session that does not exist '''
+        res = self.client().post('/quizzes/sessions/not-a-session/next')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_400_quiz_session_without_category(self):
+        ''' Test on creating a quiz session without quiz_category '''
+        res = self.client().post('/quizzes/sessions', json={'category': 3})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
     # '/categories/<string:category_id>/questions'
 
     #----------------------------------------------------------------------------#
@@ -212,13 +853,21 @@ class TriviaTestCase(unittest.TestCase):
             'type': 'Favourites'
         } 
 
-        res = self.client().post('/categories', json=new_category)
+        res = self.client().post('/categories', json=new_category,
+                                 headers={'Prefer': 'return=representation'})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertTrue(data['total_categories'])
 
+        res = self.client().post('/categories', json=new_category)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['created'])
+        self.assertFalse('categories' in data)
+
     def test_400_create_category_missing_details(self):
         '''Test for error 400 on POST while creating new category '''
 
@@ -252,6 +901,53 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['categories']))
 
+    def test_get_categories_after_create_category(self):
+        ''' Test the cached categories are refreshed when a category
+            is created, and the cache counters are reported.
+        '''
+        self.client().get('/categories')
+        res = self.client().post('/categories', json={'type': 'Cached'})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue('Cached' in data['categories'])
+
+        res = self.client().get('/admin/cache')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['caches']['categories']['misses'])
+
+    def test_304_categories_not_modified(self):
+        ''' Test conditional GET on categories with Last-Modified '''
+        # Last-Modified is sent once the second of the last write is over
+        time.sleep(1)
+        res = self.client().get('/categories')
+        last_modified = res.headers.get('Last-Modified')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(last_modified)
+
+        res = self.client().get('/categories', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(res.status_code, 304)
+
+    def test_304_not_sent_for_a_write_in_the_same_second(self):
+        ''' Test a write in the second of Last-Modified is not hidden, and the ETag wins over the date '''
+        time.sleep(1)
+        res = self.client().get('/categories')
+        etag, last_modified = res.headers['ETag'], res.headers['Last-Modified']
+
+        self.client().post('/categories', json={'type': 'Same second'})
+        res = self.client().get('/categories', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Last-Modified', res.headers)
+
+        res = self.client().get('/categories', headers={'If-None-Match': etag, 'If-Modified-Since': last_modified})
+        self.assertEqual(res.status_code, 200)
+
     def test_405_wrong_method_to_get_categories(self):
         ''' Test on category provided the wrong method
             i.e. methods other than get(), like - patch(), put() etc...
@@ -275,6 +971,32 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertEqual(data['current_category'], '3')
 
+    def test_get_questions_by_category_with_cursor(self):
+        '''Test keyset pagination inside a category, a cursor
+            issued for one category is rejected by another one
+        '''
+        res = self.client().get('/categories/3/questions?cursor=&per_page=1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['questions']), 1)
+        self.assertTrue(data['next_cursor'])
+
+        res = self.client().get('/categories/2/questions?cursor={}'.format(
+            data['next_cursor']))
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_questions_by_category_have_integer_category(self):
+        '''Test questions of a category carry the category id as integer'''
+        res = self.client().get('/categories/3/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for question in data['questions']:
+            self.assertEqual(question['category'], 3)
+
     def test_400_no_questions_within_given_category(self):
         '''Test on category provided category_id corresponding
             to which there are no questions
@@ -315,6 +1037,22 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['deleted'], category_id)
 
+    def test_delete_category_changes_row_version(self):
+        ''' Test the questions of a deleted category get a new row_version, so no worker sends their cached JSON '''
+        res = self.client().post('/categories', json={'type': 'Deleted'})
+        category_id = json.loads(res.data)['created']
+        res = self.client().post('/questions', json=dict(self.new_question, category=category_id))
+        question_id = json.loads(res.data)['created']
+        self.client().get('/questions?per_page=100')
+
+        self.client().delete('/categories/{}'.format(category_id))
+
+        with self.app.app_context():
+            self.assertEqual(Question.query.get(question_id).row_version, 2)
+        res = self.client().get('/questions?per_page=100')
+        questions = {question['id']: question for question in json.loads(res.data)['questions']}
+        self.assertIsNone(questions[question_id]['category'])
+
     def test_404_no_such_category_exist(self):
         '''test on deleting category
             provide an id which you know does not exist.
@@ -326,7 +1064,255 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_get_pool_stats(self):
+        ''' Test the connection pool reports its checkouts '''
+        self.client().get('/questions')
+        res = self.client().get('/admin/pool')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['pool']['class'], 'QueuePool')
+        self.assertTrue(data['pool']['checkouts'])
+        self.assertEqual(sum(data['pool']['wait_seconds']['buckets'].values()), data['pool']['checkouts'])
+
+    def test_reads_from_replica_until_write(self):
+        ''' Test reads go to the replica, except for a client which just wrote '''
+        app, directory = self.create_sqlite_app(replicas=1)
+        res = app.test_client().post('/categories', json={'type': 'Science'})
+        question = dict(self.new_question, category=json.loads(res.data)['created'])
+        # the replica has the schema but misses the question created next
+        shutil.copy(os.path.join(directory, 'primary.db'), os.path.join(directory, 'replica_0.db'))
+
+        client = app.test_client()
+        res = client.post('/questions', json=question)
+        self.assertEqual(res.status_code, 200)
+
+        res = client.get('/questions')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['total_questions'], 1)
+
+        res = app.test_client().get('/questions')
+        self.assertEqual(res.status_code, 404)
+
+    def test_deleted_question_id_not_reused(self):
+        ''' Test a question created after the last one was deleted gets a new id, and its own JSON '''
+        # fragments are cached per process, the other tests' databases reuse these ids
+        fragment_cache.clear()
+        app, _ = self.create_sqlite_app()
+        client = app.test_client()
+        category = json.loads(client.post('/categories', json={'type': 'Science'}).data)['created']
+        question = dict(self.new_question, category=category)
+
+        deleted = json.loads(client.post('/questions', json=question).data)['created']
+        client.get('/questions')
+        client.delete('/questions/{}'.format(deleted))
+        created = json.loads(client.post('/questions', json=dict(
+            question, question='Another test question')).data)['created']
+        data = json.loads(client.get('/questions').data)
+
+        self.assertNotEqual(created, deleted)
+        self.assertEqual([question['question'] for question in data['questions']],
+                         ['Another test question'])
+
+    def test_sqlite_enforces_foreign_keys(self):
+        ''' Test SQLite sets the category of questions to NULL when the category is deleted '''
+        app, _ = self.create_sqlite_app()
+        client = app.test_client()
+        category = json.loads(client.post('/categories', json={'type': 'Science'}).data)['created']
+        question = json.loads(client.post('/questions', json=dict(self.new_question, category=category)).data)['created']
+
+        with app.app_context():
+            from models import db
+            db.session.execute('DELETE FROM categories WHERE id = :id', {'id': category})
+            db.session.commit()
+            self.assertIsNone(Question.query.get(question).category)
+        res = client.post('/questions', json=dict(self.new_question, category=category))
+        self.assertEqual(res.status_code, 422)
+
+    def test_bank_version_read_from_primary(self):
+        ''' Test the bank version is not moved back by a replica which is behind '''
+        app, directory = self.create_sqlite_app(replicas=1)
+        shutil.copy(os.path.join(directory, 'primary.db'), os.path.join(directory, 'replica_0.db'))
+        app.test_client().post('/categories', json={'type': 'Science'})
+        with app.app_context():
+            version = bank_version.refresh()
+
+        app.test_client().get('/questions')
+
+        self.assertEqual(bank_version.value, version)
+
+    def test_etag_from_replica_which_is_behind(self):
+        ''' Test a body read from a replica which is behind is not sent under the version of the primary '''
+        app, directory = self.create_sqlite_app(replicas=1)
+        res = app.test_client().post('/categories', json={'type': 'Science'})
+        question = dict(self.new_question, category=json.loads(res.data)['created'])
+        app.test_client().post('/questions', json=question)
+        shutil.copy(os.path.join(directory, 'primary.db'), os.path.join(directory, 'replica_0.db'))
+        client = app.test_client()
+        client.post('/questions', json=question)
+
+        stale = app.test_client().get('/questions')
+        current = client.get('/questions')
+
+        self.assertEqual(json.loads(stale.data)['total_questions'], 1)
+        self.assertEqual(json.loads(current.data)['total_questions'], 2)
+        self.assertNotEqual(stale.headers['ETag'], current.headers['ETag'])
+        res = app.test_client().get('/questions', headers={
+            'If-None-Match': current.headers['ETag']})
+        self.assertEqual(res.status_code, 200)
+
+    def test_questions_stored_on_shard_of_category(self):
+        ''' Test questions go to the shard of their category and are read from every shard '''
+        shards = 2
+        app, _ = self.create_sqlite_app(shards=shards)
+
+        client = app.test_client()
+        categories = []
+        for category_type in ('Even', 'Odd'):
+            res = client.post('/categories', json={'type': category_type})
+            categories.append(json.loads(res.data)['created'])
+        for category in categories:
+            res = client.post('/questions', json=dict(
+                self.new_question, category=category))
+            self.assertEqual(res.status_code, 200)
+
+        res = client.get('/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'], 2)
+        res = client.get('/categories/{}/questions'.format(categories[0]))
+        self.assertEqual(json.loads(res.data)['total_questions'], 1)
+        res = client.get('/questions?page=101&per_page=100')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)['message'], 'bad request')
+        self.assertTrue('cursor' in json.loads(res.data)['hint'])
+
+        with app.app_context():
+            from models import db
+            for category in categories:
+                engine = db.get_engine(
+                    bind='shard_{}'.format(category % shards))
+                self.assertEqual(engine.execute(
+                    'SELECT category FROM questions').fetchall(),
+                    [(category,)])
+
+    @unittest.skipIf(asgi.databases is None, 'needs requirements-asgi.txt')
+    def test_asgi_app_answers_like_flask_app(self):
+        ''' Test the ASGI app answers the quiz and list endpoints with the JSON of the Flask app '''
+        app, _ = self.create_sqlite_app()
+        uri = app.config['SQLALCHEMY_DATABASE_URI']
+        client = app.test_client()
+        res = client.post('/categories', json={'type': 'Science'})
+        category = json.loads(res.data)['created']
+        client.post('/questions', json=dict(
+            self.new_question, category=category))
+
+        asgi_app = asgi.create_asgi_app({'SQLALCHEMY_DATABASE_URI': uri})
+        loop = asyncio.new_event_loop()
+        for path in ('/questions', '/categories',
+                     '/categories/{}/questions'.format(category),
+                     '/questions?fields=id,question',
+                     '/categories/{}/questions?include_answers=false'.format(category)):
+            status, _, data = loop.run_until_complete(
+                asgi_request(asgi_app, 'GET', path))
+            self.assertEqual(status, 200)
+            self.assertEqual(data, json.loads(client.get(path).data))
+
+        status, _, data = loop.run_until_complete(asgi_request(
+            asgi_app, 'POST', '/quizzes', {
+                'previous_questions': [],
+                'quiz_category': {'type': 'Science', 'id': category}
+            }))
+        self.assertEqual(status, 200)
+        self.assertEqual(data['question']['category'], category)
+
+        status, _, data = loop.run_until_complete(asgi_request(
+            asgi_app, 'POST', '/quizzes', {'previous_questions': []}))
+        self.assertEqual(status, 400)
+        self.assertEqual(data['success'], False)
+
+        question_id = json.loads(client.get('/questions').data)['questions'][0]['id']
+        for expected in (200, 404):
+            status, _, data = loop.run_until_complete(asgi_request(
+                asgi_app, 'DELETE', '/questions/{}'.format(question_id)))
+            self.assertEqual(status, expected)
+
+        loop.close()
+
+    def test_indexes_searched_while_questions_change(self):
+        ''' Test searches of other threads running while questions are added and removed '''
+        class EntryVersion(object):
+            # the bank version follows the entry, which is never reloaded
+            cache = None
+            value = property(lambda self: self.cache._entry['version'])
+
+        questions = [SimpleNamespace(id=question_id, question='q{}'.format(question_id),
+                                     answer='common answer')
+                     for question_id in range(1, 1001)]
+        caches = []
+        for index_class in (SearchIndex, TrigramIndex):
+            version = EntryVersion()
+            cache = version.cache = index_class(version=version, ttl=3600)
+            cache._entry = {'postings': {}, 'terms': {}, 'lengths': {}, 'texts': {},
+                            'total_length': 0, 'version': 0, 'loaded_at': time.monotonic()}
+            for question in questions[:500]:
+                cache.add(question, cache._entry['version'] + 1)
+            caches.append(cache)
+        index, trigram = caches
+        errors = []
+        done = threading.Event()
+
+        def search():
+            try:
+                while not done.is_set():
+                    index.search('q common', 0, 10)
+                    trigram.substring('q')
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=search) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for question in questions[500:]:
+            for cache in caches:
+                cache.add(question, cache._entry['version'] + 1)
+                cache.remove(question.id - 500, cache._entry['version'] + 1)
+        done.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(index.search('common', 0, 10)[1], 500)
+        self.assertEqual(len(trigram.substring('q')), 500)
+
+    def test_expired_cache_kept_while_bank_unchanged(self):
+        ''' Test an expired cache entry is checked against the bank version instead of reloaded '''
+        cache = CategoryCache(ttl=0)
+        with self.app.app_context():
+            bank_version.refresh()
+            first = cache.types()
+            second = cache.types()
+
+        self.assertEqual(first, second)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 1)
+
+    # ----------------------------------------------------------------------------#
+    # Test on 'flask db upgrade'
+    # ----------------------------------------------------------------------------#
+    def test_create_app_does_not_connect(self):
+        '''test on starting the app with an unreachable database, it connects on the first request'''
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'postgres://trivia@127.0.0.1:1/trivia'})
+
+        self.assertEqual(app.extensions['sqlalchemy'].connectors, {})
+        res = app.test_client().get('/categories')
+        self.assertEqual(res.status_code, 500)
+
+    def test_db_upgrade_is_idempotent(self):
+        '''test on running the migrations again, there is nothing left to apply'''
+        result = self.app.test_cli_runner().invoke(args=['db', 'upgrade'])
 
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue('up to date' in result.output)
 
 
 # Make the tests conveniently executable
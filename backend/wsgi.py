@@ -0,0 +1,64 @@
+'''
+Entry point of pre-fork WSGI servers, the app is loaded once in the
+master process:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Before the workers are forked the caches and indexes are built, so the
+workers share them copy-on-write until the bank changes, and every
+connection and thread of the master is closed: each worker opens its
+own in after_fork().
+'''
+import os
+import random
+
+from flaskr import create_app
+from flaskr.cache import bank_version, category_cache
+from flaskr.quiz import question_pool
+from flaskr.search import search_index, trigram_index
+from flaskr.sharding import shards
+from models import db, dispose_engines
+from pool import warm_pool
+
+
+def environ_config():
+    # settings from the environment, gunicorn.conf.py sets the pool sizes
+    config = {}
+    if 'TRIVIA_DATABASE_URL' in os.environ:
+        config['SQLALCHEMY_DATABASE_URI'] = os.environ['TRIVIA_DATABASE_URL']
+    for name in ('DB_POOL_SIZE', 'DB_MAX_OVERFLOW'):
+        value = os.environ.get('TRIVIA_' + name)
+        if value is not None:
+            config[name] = int(value)
+    return config
+
+
+app = create_app(environ_config())
+
+
+def warm_caches():
+    with app.app_context():
+        bank_version.refresh()
+        caches = [category_cache, question_pool, trigram_index]
+        if app.config['SEARCH_BACKEND'] == 'memory' or shards.enabled:
+            caches.append(search_index)
+        for cache in caches:
+            cache.warm()
+
+
+def before_fork():
+    dispose_engines(app)
+    shards.shutdown()
+    app.extensions['quiz_sessions'].close()
+
+
+def after_fork():
+    # in each worker, right after the fork
+    random.seed()
+    dispose_engines(app)
+    warm_pool(db.get_engine(app), app.config[
+        'SQLALCHEMY_ENGINE_OPTIONS'].get('pool_size', 0))
+
+
+warm_caches()
+before_fork()